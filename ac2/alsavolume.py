@@ -22,12 +22,22 @@ SOFTWARE.
 
 import threading
 import time
+import select
 import logging
 import alsaaudio
 
+# Even when waiting for mixer events, check the volume periodically
+EVENT_TIMEOUT = 10
+
+# Minimal time between two mixer writes
+MIN_WRITE_INTERVAL = 0.05
+
+# Listeners are notified if the volume didn't change for this time
+SETTLE_TIME = 0.3
+
 class ALSAVolume(threading.Thread):
 
-    def __init__(self, mixer_name):
+    def __init__(self, mixer_name, ramp_step=0):
 
         super().__init__()
 
@@ -37,6 +47,19 @@ class ALSAVolume(threading.Thread):
         self.pollinterval = 0.2
         if self.pollinterval < 0.1:
             self.pollinterval = 0.1
+        # Long-lived mixer, used if mixer events are supported
+        self.mixer = None
+        self.mixer_lock = threading.Lock()
+        self.event_driven = False
+
+        # Volume changes are merged into a target volume that is applied
+        # by a separate thread. ramp_step > 0 changes the volume smoothly
+        # in steps of this size
+        self.ramp_step = ramp_step
+        self.target = None
+        self.target_condition = threading.Condition()
+        self.settling = False
+        self.applier = None
 
         try:
             alsaaudio.Mixer(mixer_name)
@@ -51,19 +74,99 @@ class ALSAVolume(threading.Thread):
         if vol == 0 and self.volume != 0:
             self.unmuted_volume = self.volume
 
-        if vol != self.volume:
-            alsaaudio.Mixer(self.mixer_name).setvolume(int(vol),
-                                                       alsaaudio.MIXER_CHANNEL_ALL)
+        with self.target_condition:
+            if vol != self.volume or self.target is not None:
+                self.set_target(vol)
 
     def change_volume_percent(self, change):
-        vol = self.current_volume()
-        newvol = vol + change
-        if newvol < 0:
-            newvol = 0
-        elif newvol > 100:
-            newvol = 100
+        # Relative changes are added to a pending target, fast changes
+        # (e.g. from a rotary encoder) result in a single mixer write
+        with self.target_condition:
+            if self.target is not None:
+                vol = self.target
+            else:
+                vol = self.current_volume()
+            newvol = vol + change
+            if newvol < 0:
+                newvol = 0
+            elif newvol > 100:
+                newvol = 100
+
+            self.set_target(newvol)
+
+    def set_target(self, vol):
+        with self.target_condition:
+            self.target = vol
+            self.settling = True
+            if self.applier is None or not self.applier.is_alive():
+                self.applier = threading.Thread(target=self.apply_volume,
+                                                name="volume applier")
+                self.applier.daemon = True
+                self.applier.start()
+            self.target_condition.notify()
+
+    def target_volume(self):
+        """
+        Returns the volume that is being set or the current volume
+        """
+        with self.target_condition:
+            if self.target is not None:
+                return self.target
+        return self.current_volume()
+
+    def apply_volume(self):
+        while True:
+            with self.target_condition:
+                while self.target is None:
+                    self.target_condition.wait()
+
+            try:
+                self.apply_target()
+            except Exception as e:
+                logging.error("could not set ALSA volume: %s", e)
+                # Drop the target, otherwise all further changes would
+                # be ignored
+                with self.target_condition:
+                    self.target = None
+                    self.settling = False
+                continue
+
+            self.notify_listeners()
+
+    def apply_target(self):
+        """
+        Write the target volume to the mixer until it didn't change for
+        SETTLE_TIME
+        """
+        current = self.current_volume()
+        while True:
+            with self.target_condition:
+                target = self.target
 
-        self.set_volume(newvol)
+            if self.ramp_step > 0 and abs(target - current) > self.ramp_step:
+                if target > current:
+                    current = current + self.ramp_step
+                else:
+                    current = current - self.ramp_step
+            else:
+                current = target
+
+            with self.mixer_lock:
+                self.get_mixer().setvolume(int(current),
+                                           alsaaudio.MIXER_CHANNEL_ALL)
+
+            # Bounded write rate, changes in the meantime are merged
+            time.sleep(MIN_WRITE_INTERVAL)
+            if current != target:
+                continue
+
+            with self.target_condition:
+                if self.target_condition.wait_for(
+                        lambda: self.target != target, SETTLE_TIME):
+                    continue
+                self.target = None
+                self.settling = False
+                break
 
     def set_mute(self, mute):
         if mute:
@@ -76,12 +179,61 @@ class ALSAVolume(threading.Thread):
             if self.unmuted_volume > 0:
                 self.set_volume(self.unmuted_volume)
 
+    def get_mixer(self):
+        """
+        Returns the long-lived mixer in event mode. Otherwise a new mixer
+        is created as the volume of an existing mixer object isn't updated
+        without handling its events.
+        """
+        if not self.event_driven:
+            return alsaaudio.Mixer(self.mixer_name)
+
+        if self.mixer is None:
+            self.mixer = alsaaudio.Mixer(self.mixer_name)
+        return self.mixer
+
     def run(self):
+        try:
+            self.wait_for_events()
+        except Exception as e:
+            logging.info("can't use ALSA mixer events (%s), polling volume "
+                         "every %ss", e, self.pollinterval)
+
+        self.event_driven = False
         while True:
             self.notify_listeners()
             time.sleep(self.pollinterval)
 
+    def wait_for_events(self):
+        """
+        Block on the poll descriptors of the mixer and check the volume
+        only if ALSA reports a change
+        """
+        with self.mixer_lock:
+            self.event_driven = True
+            mixer = self.get_mixer()
+            descriptors = mixer.polldescriptors()
+            # raises AttributeError on old pyalsaaudio versions
+            mixer.handleevents()
+
+        poller = select.poll()
+        for (fd, eventmask) in descriptors:
+            poller.register(fd, eventmask)
+
+        logging.info("waiting for ALSA mixer events")
+        self.notify_listeners()
+        while True:
+            events = poller.poll(EVENT_TIMEOUT * 1000)
+            if len(events) > 0:
+                with self.mixer_lock:
+                    mixer.handleevents()
+            self.notify_listeners()
+
     def notify_listeners(self, always_notify=False):
+        if self.settling and not always_notify:
+            # Listeners will be notified once the volume settled
+            return
+
         current_vol = self.current_volume()
 
         # Check if this was a "mute" operation and store unmuted volume
@@ -99,7 +251,8 @@ class ALSAVolume(threading.Thread):
                                   e, listener)
 
     def current_volume(self):
-        volumes = alsaaudio.Mixer(self.mixer_name).getvolume()
+        with self.mixer_lock:
+            volumes = self.get_mixer().getvolume()
         channels = 0
         vol = 0
         for i in range(len(volumes)):
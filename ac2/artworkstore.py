@@ -0,0 +1,330 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+'''
+Content-addressed artwork store. Artwork is published under the hash of
+its content, URLs never change their content and don't reveal file
+system paths.
+'''
+
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from ac2.simple_http import get_session
+
+MAX_ENTRIES = 1000
+
+# Downloaded covers and resized variants
+CACHE_DIR = "/var/cache/audiocontrol2/artwork"
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+# Remote images larger than this won't be downloaded
+MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024
+
+# Widths of resized variants, requests are rounded up to the next bucket
+SIZE_BUCKETS = [150, 300, 600]
+
+CONTENT_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    }
+
+
+def size_bucket(width):
+    """
+    Round a requested width up to the next size bucket. Returns None if the
+    original should be used.
+    """
+    for bucket in SIZE_BUCKETS:
+        if width <= bucket:
+            return bucket
+    return None
+
+
+class ArtworkStore():
+    """
+    Maps content hashes to image files. Local files are referenced,
+    remote images are downloaded once into the cache directory. The
+    cache directory also contains resized variants, its size is limited
+    by removing the least recently used files.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, directory=CACHE_DIR,
+                 max_bytes=CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> file name
+        self.files = OrderedDict()
+        # file name -> (mtime, size, key), files are only hashed again
+        # if they changed
+        self.keys = {}
+        # remote URL -> key
+        self.urls = {}
+        self.downloading = set()
+        self.executor = ThreadPoolExecutor(max_workers=2,
+                                           thread_name_prefix="artwork")
+        # files in the cache directory -> size, in LRU order
+        self.cached = OrderedDict()
+        self.cached_bytes = 0
+        self.scan_cache()
+
+    def scan_cache(self):
+        if self.directory is None:
+            return
+
+        try:
+            entries = [e for e in os.scandir(self.directory)
+                       if e.is_file() and not e.name.endswith(".tmp")]
+        except OSError:
+            return
+
+        entries.sort(key=lambda e: e.stat().st_atime)
+        with self.lock:
+            for e in entries:
+                self.cached[e.path] = e.stat().st_size
+                self.cached_bytes += e.stat().st_size
+        logging.debug("%s bytes of artwork in cache", self.cached_bytes)
+
+    def add_file(self, filename):
+        """
+        Publish a local file, returns its key or None if the file doesn't
+        exist
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+
+        with self.lock:
+            known = self.keys.get(filename)
+        if known is not None and known[0] == st.st_mtime and known[1] == st.st_size:
+            key = known[2]
+        else:
+            key = self.hash_file(filename)
+            with self.lock:
+                self.keys[filename] = (st.st_mtime, st.st_size, key)
+
+        self.register(key, filename)
+        return key
+
+    def register(self, key, filename):
+        with self.lock:
+            self.files[key] = filename
+            self.files.move_to_end(key)
+            while len(self.files) > self.max_entries:
+                (_key, old) = self.files.popitem(last=False)
+                self.keys.pop(old, None)
+
+    def hash_file(self, filename):
+        sha = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(65536), b""):
+                sha.update(block)
+
+        (_name, ext) = os.path.splitext(filename)
+        key = sha.hexdigest()[:32] + ext.lower()
+        logging.debug("published %s as %s", filename, key)
+        return key
+
+    def add_data(self, data, ext):
+        """
+        Store image data in the cache directory, returns its key
+        """
+        key = hashlib.sha256(data).hexdigest()[:32] + ext
+        filename = os.path.join(self.directory, key)
+        if not os.path.exists(filename):
+            self.write_cache_file(filename, data)
+        self.register(key, filename)
+        return key
+
+    def add_url(self, url, callback=None):
+        """
+        Returns the key of a remote image. If it hasn't been downloaded
+        yet, the download is started in the background, this returns None
+        and callback(url, key) is called when the download is finished.
+        """
+        with self.lock:
+            key = self.urls.get(url)
+            if key is not None and key in self.files:
+                return key
+            if url in self.downloading:
+                return None
+            self.downloading.add(url)
+
+        self.executor.submit(self.download, url, callback)
+        return None
+
+    def download(self, url, callback):
+        key = None
+        try:
+            res = get_session().get(url, timeout=10, stream=True)
+            content_type = res.headers.get("Content-Type", "").split(";")[0]
+            length = int(res.headers.get("Content-Length", 0))
+            if res.status_code != 200 or not content_type.startswith("image/"):
+                logging.debug("not caching %s: HTTP %s, %s",
+                              url, res.status_code, content_type)
+            elif length > MAX_DOWNLOAD_BYTES:
+                logging.debug("not caching %s, %s bytes", url, length)
+            else:
+                data = res.raw.read(MAX_DOWNLOAD_BYTES + 1, decode_content=True)
+                if len(data) <= MAX_DOWNLOAD_BYTES:
+                    ext = CONTENT_EXTENSIONS.get(content_type)
+                    if ext is None:
+                        (_name, ext) = os.path.splitext(urlparse(url).path)
+                    key = self.add_data(data, ext.lower())
+                    logging.debug("downloaded %s as %s", url, key)
+            res.close()
+        except Exception as e:
+            logging.info("can't download artwork %s: %s", url, e)
+
+        with self.lock:
+            self.downloading.discard(url)
+            if key is not None:
+                self.urls[url] = key
+
+        if key is not None and callback is not None:
+            try:
+                callback(url, key)
+            except Exception as e:
+                logging.warning("artwork callback failed: %s", e)
+
+    def get(self, key):
+        """
+        Returns the file name for a key or None
+        """
+        with self.lock:
+            filename = self.files.get(key)
+
+        if filename is None and self.directory is not None \
+                and os.path.basename(key) == key:
+            # downloaded before a restart
+            filename = os.path.join(self.directory, key)
+            if not os.path.exists(filename):
+                return None
+            self.register(key, filename)
+
+        self.touch(filename)
+        return filename
+
+    def get_resized(self, key, width):
+        """
+        Returns the file name of a variant of this image not wider than
+        the size bucket of width. Variants are created once and cached.
+        Returns the original if it is small enough or PIL isn't
+        available.
+        """
+        filename = self.get(key)
+        bucket = size_bucket(width)
+        if filename is None or bucket is None:
+            return filename
+
+        (name, ext) = os.path.splitext(key)
+        variant = os.path.join(self.directory,
+                               "{}-w{}{}".format(name, bucket, ext))
+        if os.path.exists(variant):
+            self.touch(variant)
+            return variant
+
+        try:
+            from PIL import Image
+        except ImportError:
+            logging.debug("PIL not installed, can't resize artwork")
+            return filename
+
+        try:
+            with Image.open(filename) as image:
+                if image.width <= bucket:
+                    return filename
+                height = max(1, round(image.height * bucket / image.width))
+                resized = image.resize((bucket, height), Image.LANCZOS)
+                if resized.mode not in ["RGB", "L"] and \
+                        image.format == "JPEG":
+                    resized = resized.convert("RGB")
+                os.makedirs(self.directory, exist_ok=True)
+                tmpfile = variant + ".tmp"
+                resized.save(tmpfile, format=image.format, quality=85)
+                os.replace(tmpfile, variant)
+        except Exception as e:
+            logging.warning("can't resize %s: %s", filename, e)
+            return filename
+
+        self.add_cached(variant, os.path.getsize(variant))
+        return variant
+
+    def write_cache_file(self, filename, data):
+        os.makedirs(self.directory, exist_ok=True)
+        tmpfile = filename + ".tmp"
+        with open(tmpfile, "wb") as f:
+            f.write(data)
+        os.replace(tmpfile, filename)
+        self.add_cached(filename, len(data))
+
+    def add_cached(self, filename, size):
+        with self.lock:
+            if filename in self.cached:
+                self.cached_bytes -= self.cached[filename]
+            self.cached[filename] = size
+            self.cached_bytes += size
+        self.evict()
+
+    def touch(self, filename):
+        with self.lock:
+            if filename in self.cached:
+                self.cached.move_to_end(filename)
+
+    def evict(self):
+        """
+        Remove least recently used files until the cache directory is
+        smaller than max_bytes
+        """
+        removed = []
+        with self.lock:
+            while self.cached_bytes > self.max_bytes and len(self.cached) > 1:
+                (filename, size) = self.cached.popitem(last=False)
+                self.cached_bytes -= size
+                removed.append(filename)
+                key = os.path.basename(filename)
+                if self.files.get(key) == filename:
+                    del self.files[key]
+
+        for filename in removed:
+            logging.debug("removing %s from artwork cache", filename)
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def content_type(self, key):
+        (mimetype, _encoding) = mimetypes.guess_type(key)
+        if mimetype is None:
+            return "application/octet-stream"
+        return mimetype
@@ -24,8 +24,8 @@ SOFTWARE.
 import time
 import logging
 import datetime
-import copy
-from random import randint
+import json
+import queue
 import threading
 
 from ac2.constants import CMD_NEXT, CMD_PAUSE, CMD_PLAY, CMD_PLAYPAUSE, \
@@ -33,7 +33,8 @@ from ac2.constants import CMD_NEXT, CMD_PAUSE, CMD_PLAY, CMD_PLAYPAUSE, \
 
 from ac2.players.mpdcontrol import MPDControl
 from ac2.players.mpris import MPRIS, MPRIS_PREFIX
-from ac2.metadata import Metadata, enrich_metadata_bg
+from ac2.metadata import Metadata, enrich_metadata_bg, prefetch_metadata_bg
+from ac2.pollscheduler import PollScheduler
 # from ac2.controller import PlayerController
 from ac2 import watchdog
 
@@ -44,6 +45,16 @@ mpris = None
 # SPOTIFY_NAME = "spotifyd"
 LMS_NAME = "lms"
 
+# Events that wake up the main loop
+EVENT_PLAYER = "player"
+EVENT_COMMAND = "command"
+
+# Scan interval if all players report their changes
+HEALTH_INTERVAL = 10
+
+# Metadata of stopped players is refreshed only from time to time
+STOPPED_METADATA_INTERVAL = 600
+
 
 class PlayerState:
     """
@@ -58,6 +69,10 @@ class PlayerState:
         else:
             self.metadata = Metadata()
         self.supported_commands = []
+        # Latest MPRIS snapshot, not yet consumed by get_meta
+        self.snapshot = None
+        # time.monotonic() of the last metadata update
+        self.metadata_updated = 0
 
     def __str__(self):
         return self.state + str(self.metadata)
@@ -86,6 +101,20 @@ class AudioController():
         self.players={}
         self.mpris = MPRIS()
         self.mpris.connect_dbus()
+        self.mpris.change_callback = self.player_changed
+        # Players and commands post events here, the main loop only runs
+        # when there's an event or for a periodic health check
+        self.events = queue.Queue()
+        self.health_interval = HEALTH_INTERVAL
+        # Next poll time for each player depending on its state
+        self.poll_scheduler = PollScheduler()
+        # Serialized player states, only updated if something changed
+        self.states_condition = threading.Condition()
+        self.states_version = 0
+        self.states_players = None
+        self.states_json = json.dumps(self.states())
+        # Number of upcoming songs that will be enriched in advance
+        self.prefetch_count = 2
         
     
     """
@@ -93,6 +122,10 @@ class AudioController():
     """
     def register_nonmpris_player(self,name,controller):
         self.players[name]=controller
+        # Use the registered name, it might differ from the playername
+        # reported by the player
+        controller.set_update_listener(
+            lambda _playername: self.player_changed(name))
         
     def register_metadata_display(self, mddisplay):
         self.metadata_displays.append(mddisplay)
@@ -106,6 +139,78 @@ class AudioController():
     def set_volume_control(self, volume_control):
         self.volume_control = volume_control
 
+    def listen_mpris_signals(self):
+        """
+        Use D-Bus signals instead of polling for MPRIS players
+        """
+        return self.mpris.start_listener()
+
+    def player_changed(self, name):
+        """
+        Called by player backends when state or metadata of a player
+        changed. This wakes up the main loop immediately.
+        """
+        logging.debug("player %s changed", name)
+        self.post_event(EVENT_PLAYER, name)
+
+    def post_event(self, event, name=None):
+        self.events.put((event, name))
+
+    def wait_for_events(self, timeout):
+        """
+        Wait until at least one event has been posted or the timeout is
+        over. Returns all pending events.
+        """
+        try:
+            events = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def is_event_driven(self, name):
+        """
+        Check if a player reports its changes and doesn't need to be
+        polled
+        """
+        if name in self.players:
+            return self.players[name].is_event_driven()
+        else:
+            return self.mpris.sends_signals(name)
+
+    def poll_statistics(self):
+        """
+        Backend calls per minute and the poll schedule of all players
+        """
+        return self.poll_scheduler.statistics()
+
+    def dbus_statistics(self):
+        """
+        Hit/miss counters of the D-Bus proxy cache
+        """
+        return self.mpris.get_interface_stats()
+
+    def notify_statistics(self):
+        """
+        Queue depth, dropped notifications and latencies of all metadata
+        displays
+        """
+        stats = {}
+        for md in self.metadata_displays:
+            if not hasattr(md, "notify_statistics"):
+                continue
+            name = type(md).__name__
+            i = 1
+            while name in stats:
+                i += 1
+                name = "{}-{}".format(type(md).__name__, i)
+            stats[name] = md.notify_statistics()
+        return stats
+
     def metadata_notify(self, metadata):
         if metadata.is_unknown() and metadata.playerState == "playing":
             logging.warning("Metadata without artist, album or title - what's wrong here? %s",
@@ -114,13 +219,30 @@ class AudioController():
         for md in self.metadata_displays:
             try:
                 logging.debug("metadata_notify: %s %s", md, metadata)
-                md.notify_async(copy.copy(metadata))
+                md.notify_async(metadata.copy())
             except Exception as e:
                 logging.warning("could not notify %s: %s", md, e)
                 logging.exception(e)
 
         self.metadata = metadata
 
+    def metadata_notify_delta(self, metadata, changes):
+        """
+        Send only the changed attributes to displays that support this,
+        all other displays get the full metadata
+        """
+        songId = metadata.songId()
+        for md in self.metadata_displays:
+            try:
+                if getattr(md, "delta_notifications", False):
+                    logging.debug("metadata_notify_delta: %s %s", md, changes)
+                    md.notify_delta_async(songId, changes)
+                else:
+                    md.notify_async(metadata.copy())
+            except Exception as e:
+                logging.warning("could not notify %s: %s", md, e)
+                logging.exception(e)
+
 
     def all_players(self):
         """
@@ -141,7 +263,14 @@ class AudioController():
         if name in self.players.keys():
             return self.players[name].get_state()
         else:
-            return self.mpris.retrieve_state(name)
+            # A single D-Bus round trip delivers state, metadata and
+            # capabilities of an MPRIS player
+            snapshot = self.mpris.snapshot(name)
+            if name in self.state_table:
+                ps = self.state_table[name]
+                ps.snapshot = snapshot
+                ps.supported_commands = snapshot["supported_commands"]
+            return snapshot["state"]
         
     def get_supported_commands(self, name):
         if name in self.players.keys():
@@ -194,6 +323,7 @@ class AudioController():
 
         res = self.send_command_to_player(playerName, command)    
         logging.info("sent %s to %s", command, playerName)
+        self.post_event(EVENT_COMMAND, playerName)
 
         return res
 
@@ -211,6 +341,10 @@ class AudioController():
     def get_meta(self, name):
         if name in self.players.keys():
             md=self.players[name].get_meta()
+        elif name in self.state_table and \
+                self.state_table[name].snapshot is not None:
+            md=self.state_table[name].snapshot["metadata"]
+            self.state_table[name].snapshot = None
         else:
             md=self.mpris.get_meta(name)
             
@@ -224,6 +358,28 @@ class AudioController():
             
         return md
                 
+    def prefetch_upcoming(self, name):
+        """
+        Start retrieving external metadata for the next songs of the player
+        """
+        if self.prefetch_count <= 0 or name not in self.players:
+            return
+        
+        try:
+            upcoming = self.players[name].upcoming(self.prefetch_count)
+        except Exception as e:
+            logging.debug("can't retrieve upcoming songs from %s: %s", name, e)
+            return
+        
+        for md in upcoming:
+            md.fix_problems(guess=False)
+            for p in self.metadata_processors:
+                p.process_metadata(md)
+            
+        logging.debug("prefetching metadata for %s", 
+                      [str(md) for md in upcoming])
+        prefetch_metadata_bg(upcoming)
+                
     def update_metadata_attributes(self, updates, songId):
         logging.debug("received metadata update: %s", updates)
 
@@ -239,10 +395,15 @@ class AudioController():
         # Otherwise it might be a delayed update
 
         with self.metadata_lock:
-            for attribute in updates:
-                self.metadata.__dict__[attribute] = updates[attribute]
+            before = self.metadata.copy()
+            self.metadata.set_attributes(updates)
+            changes = self.metadata.diff(before)
 
-        self.metadata_notify(self.metadata)
+        if len(changes) == 0:
+            logging.debug("metadata update didn't change anything")
+            return
+
+        self.metadata_notify_delta(self.metadata, changes)
 
     def main_loop(self):
         """
@@ -267,7 +428,6 @@ class AudioController():
         ts = datetime.datetime.now()
 
         while not(finished):
-            additional_delay = 0
             new_player_started = None
             metadata_notified = False
             playing = False
@@ -277,10 +437,16 @@ class AudioController():
             ts = datetime.datetime.now()
             duration = (ts-last_ts).total_seconds()
 
-            for p in self.all_players():
+            self.poll_scheduler.set_interval(STATE_PLAYING, self.loop_delay)
+            self.poll_scheduler.event_driven_interval = self.health_interval
+            now = time.monotonic()
+            # Ignored players are never scheduled
+            players = [p for p in self.all_players()
+                       if self.playername(p) not in self.ignore_players]
+            self.poll_scheduler.retain(players)
+            polled = []
 
-                if self.playername(p) in self.ignore_players:
-                    continue
+            for p in players:
                 
                 if p not in self.state_table:
                     ps = PlayerState()
@@ -290,6 +456,18 @@ class AudioController():
                                   ps.supported_commands)
                     self.state_table[p] = ps
 
+                if not self.poll_scheduler.is_due(p, now):
+                    # Keep the last known state until the next poll
+                    if self.state_table[p].state == STATE_PLAYING:
+                        playing = True
+                        state = "playing"
+                        metadata_notified = True
+                        if self.playername(p) == LMS_NAME:
+                            squeezelite_active = 2
+                        report_usage("audiocontrol_playing_{}".format(self.playername(p)),duration)
+                    continue
+
+                polled.append(p)
                 thisplayer_state = "unknown"
                 try:
                     thisplayer_state = self.get_player_state(p).lower()
@@ -307,6 +485,9 @@ class AudioController():
                         self.state_table[p].failed = 0
 
                 self.state_table[p].state = thisplayer_state
+                self.poll_scheduler.polled(p, thisplayer_state,
+                                           failed=self.state_table[p].failed > 0,
+                                           event_driven=self.is_event_driven(p))
 
                 # Check if playback started on a player that wasn't
                 # playing before
@@ -339,6 +520,7 @@ class AudioController():
                         new_song = True
 
                     self.state_table[p].metadata = md
+                    self.state_table[p].metadata_updated = now
                     if not(md.sameSong(self.metadata)):
                         logging.debug("updated metadata: \nold %s\nnew %s",
                                       self.metadata,
@@ -364,6 +546,7 @@ class AudioController():
                     if new_song:
                         enrich_metadata_bg(md, callback=self)
                         logging.debug("metadata updater thread started")
+                        self.prefetch_upcoming(p)
 
                     # Even if we din't send metadata, this is still
                     # flagged
@@ -377,11 +560,12 @@ class AudioController():
                             active_players.remove(p)
 
                     # update metadata for stopped players from time to time
-                    i = randint(0, 600)
-                    if (i == 0):
+                    if now - self.state_table[p].metadata_updated > \
+                            STOPPED_METADATA_INTERVAL:
                         md = self.get_meta(p)
                         md.playerState = thisplayer_state
                         self.state_table[p].metadata = md
+                        self.state_table[p].metadata_updated = now
 
             self.playing = playing
 
@@ -424,7 +608,10 @@ class AudioController():
             # or stopped
             if not(playing) and len(active_players) > 0:
                 p = active_players[0]
-                md = self.get_meta(p)
+                if p in polled:
+                    md = self.get_meta(p)
+                else:
+                    md = self.state_table[p].metadata.copy()
                 md.playerState = self.state_table[p].state
                 state = md.playerState
 
@@ -448,8 +635,21 @@ class AudioController():
                     logging.debug("auto-pause disabled")
 
             self.last_update = datetime.datetime.now()
-
-            time.sleep(self.loop_delay+additional_delay)
+            self.update_states()
+
+            # Wait until a player reports a change, a command has been
+            # sent or the next player is due
+            timeout = self.health_interval
+            next_due = self.poll_scheduler.next_due()
+            if next_due is not None:
+                timeout = min(timeout, max(0, next_due - time.monotonic()))
+            events = self.wait_for_events(timeout)
+            if len(events) > 0:
+                logging.debug("woke up by %s", events)
+            for (_event, name) in events:
+                if name is not None and \
+                        self.playername(name) not in self.ignore_players:
+                    self.poll_scheduler.poll_now(name)
 
     # ##
     # ## controller functions
@@ -492,6 +692,34 @@ class AudioController():
     def __str__(self):
         return "mpris"
 
+    def update_states(self):
+        """
+        Serialize the player states if these changed and wake up clients
+        that are waiting for a change
+        """
+        players = self.states()["players"]
+        if players == self.states_players:
+            return
+
+        with self.states_condition:
+            self.states_players = players
+            self.states_json = json.dumps({
+                "players": players,
+                "last_updated": str(self.last_update)})
+            self.states_version += 1
+            self.states_condition.notify_all()
+
+    def versioned_states(self, version=None, timeout=0):
+        """
+        Returns (version, JSON) of the player states. If version is given,
+        waits up to timeout seconds until the states changed.
+        """
+        with self.states_condition:
+            if version is not None and timeout > 0:
+                self.states_condition.wait_for(
+                    lambda: self.states_version != version, timeout)
+            return (self.states_version, self.states_json)
+
     def states(self):
         players = []
         for p in self.state_table:
@@ -500,7 +728,7 @@ class AudioController():
             player["state"] = self.state_table[p].state
             player["artist"] = self.state_table[p].metadata.artist
             player["title"] = self.state_table[p].metadata.title
-            player["supported_commands"] = self.state_table[p].supported_commands;
+            player["supported_commands"] = list(self.state_table[p].supported_commands)
 
             players.append(player)
 
@@ -26,18 +26,100 @@ from expiringdict import ExpiringDict
 covers = ExpiringDict(max_len=1000,
                       max_age_seconds=3600000)
 
-import io
 import struct
-import urllib.request as urllib2
+
+from ac2.simple_http import get_session
 
 GOOD_ENOUGH_WIDTH = 1000
 GOOD_ENOUGH_HEIGHT = 1000
 
+# Image headers are probed with a byte range request. The probe stops as
+# soon as the dimensions can be decoded, the range only limits the worst
+# case (e.g. JPEGs with large embedded EXIF/ICC data)
+PROBE_CHUNK_SIZE = 4096
+PROBE_MAX_BYTES = 256 * 1024
+
+# The rest of a partial response is read if it's not longer than this,
+# the connection can then be reused
+PROBE_DRAIN_BYTES = 32 * 1024
+
+# Image dimensions by URL, an image is never probed twice
+dimensions = ExpiringDict(max_len=5000,
+                          max_age_seconds=3600000)
+
+# Failed probes (e.g. a server error) are only retried after some time
+PROBE_ERROR_TTL = 600
+failed_probes = ExpiringDict(max_len=1000,
+                             max_age_seconds=PROBE_ERROR_TTL)
+
+# JPEG start of frame markers (0xC4, 0xC8 and 0xCC are not SOF markers)
+JPEG_SOF_MARKERS = [0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF]
+
+
+def jpeg_size(data):
+    """
+    Find the dimensions in the SOF segment of a JPEG. Returns (-1, -1) if
+    the data are truncated before the SOF segment.
+    """
+    size = len(data)
+    pos = 2
+    while pos + 4 <= size:
+        if data[pos] != 0xFF:
+            # not a marker, resync
+            pos += 1
+            continue
+
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            # standalone markers without length
+            pos += 2
+            continue
+
+        if marker == 0xDA:
+            # start of scan, no SOF found before
+            break
+
+        length = struct.unpack(b">H", data[pos + 2:pos + 4])[0]
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 9 > size:
+                break
+            h, w = struct.unpack(b">HH", data[pos + 5:pos + 9])
+            return int(w), int(h)
+
+        pos += 2 + length
+
+    return -1, -1
+
+
+def webp_size(data):
+    """
+    Find the dimensions of a WebP image (lossy, lossless or extended)
+    """
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and len(data) >= 30:
+        w, h = struct.unpack(b"<HH", data[26:30])
+        return w & 0x3FFF, h & 0x3FFF
+
+    if chunk == b'VP8L' and len(data) >= 25:
+        bits = struct.unpack(b"<L", data[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+
+    if chunk == b'VP8X' and len(data) >= 30:
+        w = int.from_bytes(data[24:27], "little") + 1
+        h = int.from_bytes(data[27:30], "little") + 1
+        return w, h
+
+    return -1, -1
+
 
 def getImageInfo(data):
-    data = data
     size = len(data)
-    # print(size)
     height = -1
     width = -1
     content_type = ''
@@ -61,7 +143,8 @@ def getImageInfo(data):
         height = int(h)
 
     # Maybe this is for an older PNG version.
-    elif (size >= 16) and data.startswith(b'\211PNG\r\n\032\n'):
+    elif (size >= 16) and data.startswith(b'\211PNG\r\n\032\n') \
+            and data[12:16] != b'IHDR':
         # Check to see if we have the right content type
         content_type = 'image/png'
         w, h = struct.unpack(b">LL", data[8:16])
@@ -71,32 +154,70 @@ def getImageInfo(data):
     # handle JPEGs
     elif (size >= 2) and data.startswith(b'\377\330'):
         content_type = 'image/jpeg'
-        jpeg = io.BytesIO(data)
-        jpeg.read(2)
-        b = jpeg.read(1)
-        try:
-            while (b and ord(b) != 0xDA):
-                while (ord(b) != 0xFF): b = jpeg.read(1)
-                while (ord(b) == 0xFF): b = jpeg.read(1)
-                if (ord(b) >= 0xC0 and ord(b) <= 0xC3):
-                    jpeg.read(3)
-                    h, w = struct.unpack(b">HH", jpeg.read(4))
-                    break
-                else:
-                    jpeg.read(int(struct.unpack(b">H", jpeg.read(2))[0]) - 2)
-                b = jpeg.read(1)
-            width = int(w)
-            height = int(h)
-        except struct.error:
-            pass
-        except ValueError:
-            pass
-
-    logging.debug("parsed image")
+        width, height = jpeg_size(data)
+
+    # handle WebP
+    elif (size >= 16) and data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        content_type = 'image/webp'
+        width, height = webp_size(data)
 
     return content_type, width, height
 
 
+def probe_image_size(url):
+    """
+    Read the header of an image incrementally until its dimensions are
+    known. Results are cached by URL.
+    """
+    if url in dimensions:
+        return dimensions[url]
+    if url in failed_probes:
+        return (0, 0)
+
+    data = b''
+    width = height = -1
+    response = get_session().get(url,
+                                 headers={"Range": "bytes=0-{}".format(PROBE_MAX_BYTES - 1)},
+                                 stream=True,
+                                 timeout=10)
+    try:
+        if response.status_code not in [200, 206]:
+            logging.debug("can't probe %s, HTTP status %s",
+                          url, response.status_code)
+            failed_probes[url] = True
+            return (0, 0)
+
+        for chunk in response.iter_content(chunk_size=PROBE_CHUNK_SIZE):
+            data += chunk
+            _type, width, height = getImageInfo(data)
+            if width > 0 and height > 0:
+                break
+            if len(data) >= PROBE_MAX_BYTES:
+                break
+        # A short rest of a range response is read to keep the connection.
+        # Otherwise (e.g. the server sent the whole image) closing the
+        # response drops the connection, this is faster than downloading
+        # the rest of the image.
+        try:
+            remaining = int(response.headers.get("Content-Length")) - len(data)
+        except (TypeError, ValueError):
+            remaining = -1
+        if response.status_code == 206 and 0 < remaining <= PROBE_DRAIN_BYTES:
+            for _chunk in response.iter_content(chunk_size=PROBE_CHUNK_SIZE):
+                pass
+    finally:
+        response.close()
+
+    logging.debug("probed %s bytes of %s: %sx%s", len(data), url, width, height)
+
+    if width > 0 and height > 0:
+        dimensions[url] = (width, height)
+        return (width, height)
+    else:
+        failed_probes[url] = True
+        return (0, 0)
+
+
 class Coverart():
 
     def __init__(self, url, width=0, height=0):
@@ -111,10 +232,7 @@ class Coverart():
 
             if self.size() == 0:
                 try:
-                    req = urllib2.Request(url, headers={"Range": "5000"})
-                    r = urllib2.urlopen(req)
-
-                    _type, self.width, self.height = getImageInfo(r.read())
+                    self.width, self.height = probe_image_size(url)
                 except Exception as e:
                     logging.warning("error while parsing image from %s: %s",
                                     url, e)
@@ -166,6 +284,14 @@ def best_picture_url(key, url, width=0, height=0):
         covers[key] = cover
         return cover.url
     
+def best_picture(key):
+    """
+    Returns the URL of the best picture that is known for this key
+    """
+    existing_cover = covers.get(key)
+    if existing_cover is not None:
+        return existing_cover.url
+
 def best_picture_size(key):
     
     if key is None:
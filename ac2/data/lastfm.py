@@ -102,7 +102,7 @@ def enrich_metadata(metadata):
 
         if metadata.albumArtist is None:
             try:
-                metadata.albumartist = albumdata["album"]["artist"]
+                metadata.albumArtist = albumdata["album"]["artist"]
                 logging.debug("added album artist from Last.FM")
             except KeyError:
                 # mbid might not be available
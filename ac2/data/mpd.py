@@ -25,14 +25,383 @@ Get metadata from MPD
 '''
 
 import logging
+import os
+import json
+import hashlib
+import threading
+import time
+from queue import Queue
 from pathlib import Path
 
+from mpd import MPDClient
+
+INDEX_FILE = "/var/cache/audiocontrol2/mpd-covers.json"
+ARTWORK_DIR = "/var/cache/audiocontrol2/mpd-artwork"
+
+# File names for directory covers, in order of preference
+COVER_NAMES = ["cover", "front", "folder"]
+COVER_EXTENSIONS = [".jpg", ".jpeg", ".png", ".gif"]
+COVER_FILES = [b + ext for b in COVER_NAMES for ext in COVER_EXTENSIONS]
+
+# Directories without a known cover are checked again at most this often
+# when a song from this directory is looked up
+REFRESH_INTERVAL = 3600
+
+# Changes of the index are written to disk with this delay
+SAVE_DELAY = 60
+
+IMAGE_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    }
+
+
+def find_cover(filenames):
+    """
+    Select the preferred cover from a list of file names
+    """
+    best = None
+    best_rank = len(COVER_FILES)
+    for name in filenames:
+        try:
+            rank = COVER_FILES.index(name.lower())
+        except ValueError:
+            continue
+        if rank < best_rank:
+            best = name
+            best_rank = rank
+    return best
+
+
+class CoverIndex():
+    """
+    Maps music directories to their cover file. The index is built once
+    in the background and stored on disk. It is kept up to date using
+    inotify (if inotify_simple is installed). Directories without a
+    known cover are also checked again in the background when they are
+    looked up. Lookups never access the file system.
+    """
+
+    def __init__(self, basedir, filename=INDEX_FILE,
+                 refresh_interval=REFRESH_INTERVAL, save_delay=SAVE_DELAY):
+        self.base = str(basedir)
+        self.filename = filename
+        self.refresh_interval = refresh_interval
+        self.save_delay = save_delay
+        self.lock = threading.Lock()
+        # relative directory -> cover file name (None: no cover)
+        self.covers = {}
+        # song URI -> extracted embedded picture (None: no picture)
+        self.embedded = {}
+        self.loaded = False
+        # relative directory -> time.monotonic() of the last refresh
+        self.refreshed = {}
+        self.refresh_queue = Queue()
+        self.save_timer = None
+        self.load()
+
+    def load(self):
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+            if data.get("base") == self.base and \
+                    isinstance(data.get("covers"), dict):
+                self.covers = data["covers"]
+                self.embedded = data.get("embedded", {})
+                self.loaded = True
+                logging.info("loaded cover index with %s directories",
+                             len(self.covers))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("can't load cover index %s: %s", self.filename, e)
+
+    def save_later(self):
+        """
+        Save the index after SAVE_DELAY, changes in the meantime are
+        written together
+        """
+        with self.lock:
+            if self.save_timer is not None:
+                return
+            self.save_timer = threading.Timer(self.save_delay, self.save)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    def save(self):
+        if self.filename is None:
+            return
+        with self.lock:
+            self.save_timer = None
+            data = {
+                "base": self.base,
+                "covers": dict(self.covers),
+                "embedded": dict(self.embedded)
+                }
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmpfile = self.filename + ".tmp"
+            with open(tmpfile, "w") as f:
+                json.dump(data, f)
+            os.replace(tmpfile, self.filename)
+        except Exception as e:
+            logging.warning("can't save cover index %s: %s", self.filename, e)
+
+    def start(self):
+        thread = threading.Thread(target=self.run,
+                                  name="cover index")
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        # Walking large (network) music libraries is slow, the index is
+        # only built if there's no saved one
+        if not self.loaded:
+            self.build()
+
+        refresher = threading.Thread(target=self.refresh_directories,
+                                     name="cover index refresh")
+        refresher.daemon = True
+        refresher.start()
+
+        try:
+            self.watch()
+        except ImportError:
+            logging.info("inotify_simple not installed, covers are only "
+                         "updated when they are looked up")
+        except Exception as e:
+            logging.warning("can't watch %s for changes: %s", self.base, e)
+
+    def build(self):
+        logging.info("building cover index for %s", self.base)
+        start = time.monotonic()
+        covers = {}
+        for dirpath, _dirnames, filenames in os.walk(self.base):
+            covers[self.relative(dirpath)] = find_cover(filenames)
+
+        with self.lock:
+            self.covers = covers
+            self.loaded = True
+        logging.info("indexed %s directories in %.1fs",
+                     len(covers), time.monotonic() - start)
+        self.save()
+
+    def request_refresh(self, directory):
+        """
+        Check a directory again in the background, at most once per
+        refresh interval
+        """
+        now = time.monotonic()
+        with self.lock:
+            last = self.refreshed.get(directory)
+            if last is not None and now - last < self.refresh_interval:
+                return
+            self.refreshed[directory] = now
+        self.refresh_queue.put(directory)
+
+    def refresh_directories(self):
+        while True:
+            directory = self.refresh_queue.get()
+            with self.lock:
+                cover = self.covers.get(directory)
+            self.update_directory(os.path.join(self.base, directory))
+            with self.lock:
+                changed = self.covers.get(directory) != cover
+            if changed:
+                logging.debug("cover of %s changed", directory)
+                self.save_later()
+
+    def update_directory(self, dirpath):
+        try:
+            cover = find_cover(os.listdir(dirpath))
+        except OSError:
+            # directory has been removed
+            with self.lock:
+                self.covers.pop(self.relative(dirpath), None)
+            return
+
+        with self.lock:
+            self.covers[self.relative(dirpath)] = cover
+
+    def watch(self):
+        from inotify_simple import INotify, flags
+
+        mask = flags.CREATE | flags.DELETE | flags.MOVED_FROM | \
+            flags.MOVED_TO | flags.CLOSE_WRITE | flags.ONLYDIR
+        inotify = INotify()
+        watches = {}
+
+        def add_watches(top):
+            for dirpath, _dirnames, _filenames in os.walk(top):
+                try:
+                    watches[inotify.add_watch(dirpath, mask)] = dirpath
+                except OSError as e:
+                    logging.debug("can't watch %s: %s", dirpath, e)
+
+        # The directories are already known from the index
+        with self.lock:
+            directories = list(self.covers.keys())
+        for directory in directories:
+            dirpath = os.path.normpath(os.path.join(self.base, directory))
+            try:
+                watches[inotify.add_watch(dirpath, mask)] = dirpath
+            except OSError as e:
+                logging.debug("can't watch %s: %s", dirpath, e)
+        logging.info("watching %s directories for cover changes", len(watches))
+
+        while True:
+            changed = False
+            for event in inotify.read(read_delay=1000):
+                dirpath = watches.get(event.wd)
+                if dirpath is None:
+                    continue
+                if event.mask & flags.ISDIR:
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        subdir = os.path.join(dirpath, event.name)
+                        add_watches(subdir)
+                        for sub, _d, filenames in os.walk(subdir):
+                            with self.lock:
+                                self.covers[self.relative(sub)] = \
+                                    find_cover(filenames)
+                    else:
+                        self.update_directory(os.path.join(dirpath,
+                                                           event.name))
+                else:
+                    self.update_directory(dirpath)
+                changed = True
+
+            if changed:
+                self.save_later()
+
+    def relative(self, dirpath):
+        return os.path.relpath(dirpath, self.base)
+
+    def lookup(self, songfile):
+        """
+        Returns the cover of the directory of the given song (relative to
+        the base directory) or None
+        """
+        directory = os.path.dirname(os.path.normpath(songfile)) or "."
+        with self.lock:
+            cover = self.covers.get(directory)
+        if cover is None:
+            self.request_refresh(directory)
+            return None
+        return os.path.join(self.base, directory, cover)
+
+    def lookup_embedded(self, songfile):
+        """
+        Returns (known, filename) for the picture embedded in this song
+        """
+        with self.lock:
+            if songfile in self.embedded:
+                return True, self.embedded[songfile]
+        return False, None
+
+    def set_embedded(self, songfile, filename):
+        with self.lock:
+            self.embedded[songfile] = filename
+
+
+class EmbeddedArtworkLoader(threading.Thread):
+    """
+    Retrieves artwork embedded in songs (readpicture) or stored next to
+    them (albumart) from MPD and stores it in the artwork directory
+    """
+
+    def __init__(self, index, host="localhost", port=6600,
+                 artwork_dir=ARTWORK_DIR):
+        super().__init__()
+        self.daemon = True
+        self.index = index
+        self.host = host
+        self.port = port
+        self.artwork_dir = artwork_dir
+        self.queue = Queue()
+        self.requested = set()
+        self.client = None
+
+    def request(self, songfile):
+        if songfile in self.requested:
+            return
+        self.requested.add(songfile)
+        self.queue.put(songfile)
+
+    def run(self):
+        while True:
+            songfile = self.queue.get()
+            try:
+                filename = self.retrieve(songfile)
+                self.index.set_embedded(songfile, filename)
+                self.index.save_later()
+            except Exception as e:
+                logging.debug("can't retrieve artwork for %s from MPD: %s",
+                              songfile, e)
+                self.disconnect()
+                # try again later
+                self.requested.discard(songfile)
+
+    def connect(self):
+        if self.client is None:
+            client = MPDClient()
+            client.timeout = 10
+            client.connect(self.host, self.port)
+            self.client = client
+        return self.client
+
+    def disconnect(self):
+        if self.client is not None:
+            try:
+                self.client.disconnect()
+            except:
+                pass
+        self.client = None
+
+    def retrieve(self, songfile):
+        client = self.connect()
+        picture = None
+        for command in [client.readpicture, client.albumart]:
+            try:
+                picture = command(songfile)
+            except Exception as e:
+                logging.debug("%s failed for %s: %s",
+                              command.__name__, songfile, e)
+                continue
+            if picture is not None and picture.get("binary"):
+                break
+            picture = None
+
+        if picture is None:
+            logging.debug("no artwork for %s in MPD", songfile)
+            return None
+
+        data = picture["binary"]
+        ext = IMAGE_EXTENSIONS.get(picture.get("type"), ".jpg")
+        filename = os.path.join(self.artwork_dir,
+                                hashlib.sha1(data).hexdigest() + ext)
+        if not os.path.exists(filename):
+            os.makedirs(self.artwork_dir, exist_ok=True)
+            with open(filename, "wb") as f:
+                f.write(data)
+        logging.debug("stored artwork of %s in %s", songfile, filename)
+        return filename
+
+
 class MpdMetadataProcessor():
     
-    def __init__(self, basedir="/"):
+    def __init__(self, basedir="/", index_file=INDEX_FILE, 
+                 embedded=False, host="localhost", port=6600):
         self.base=Path(basedir)
-        self.currentCover=None
-        self.currentUrl=None
+        self.index = CoverIndex(basedir, index_file)
+        self.index.start()
+        self.loader = None
+        if embedded:
+            self.loader = EmbeddedArtworkLoader(self.index, host, port)
+            self.loader.start()
         
         
     def process_metadata(self, metadata):
@@ -40,21 +409,25 @@ class MpdMetadataProcessor():
             url = metadata.streamUrl
             
             if metadata.artUrl is None and url is not None:
-                
-                if url == self.currentUrl:
-                    metadata.artUrl=self.currentCover
-                else:
-                    musicfile = Path(self.base, metadata.streamUrl)
-                    self.currentCover=self.coverart(musicfile)
-                    self.currentUrl=url
-                    metadata.artUrl="file://"+str(self.currentCover)
+                cover = self.coverart(url)
+                if cover is not None:
+                    metadata.artUrl="file://"+cover
                 
                 
-    def coverart(self, musicfile):
-        musicdir = musicfile.parents[0]
-        for f in Path(musicdir).glob("*.???*"):
-            for b in ["cover","front","folder"]:
-                for ext in [".jpg",".jpeg",".png",".gif"]:
-                    if str(f.name).lower() == b+ext:
-                        return str(f)
-                
+    def coverart(self, songfile):
+        """
+        Cover for a song from the index. Embedded artwork is used if there
+        is no cover file in the directory.
+        """
+        if "://" in songfile:
+            # web radio
+            return None
+
+        cover = self.index.lookup(songfile)
+        if cover is not None or self.loader is None:
+            return cover
+
+        (known, cover) = self.index.lookup_embedded(songfile)
+        if not known:
+            self.loader.request(songfile)
+        return cover
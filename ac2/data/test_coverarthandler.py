@@ -0,0 +1,139 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import unittest
+import struct
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from ac2.data import coverarthandler
+from ac2.data.coverarthandler import getImageInfo, probe_image_size
+
+
+def png_header(width, height):
+    return b'\211PNG\r\n\032\n' + struct.pack(b">L", 13) + b'IHDR' + \
+        struct.pack(b">LL", width, height) + b'\x08\x06\x00\x00\x00'
+
+
+def jpeg_header(width, height, exif_size=1000):
+    app1 = b'\xff\xe1' + struct.pack(b">H", exif_size + 2) + b'\x00' * exif_size
+    sof = b'\xff\xc0' + struct.pack(b">HBHHB", 17, 8, height, width, 3) + b'\x00' * 9
+    return b'\xff\xd8' + app1 + sof + b'\xff\xda'
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+
+    requests = []
+    image = png_header(640, 480) + b'\x00' * 100000
+
+    def do_GET(self):
+        ImageHandler.requests.append(self.headers.get("Range"))
+        if self.path == "/broken.png":
+            image = b'\x00' * 1000
+        else:
+            image = self.image
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(image)))
+        self.end_headers()
+        try:
+            self.wfile.write(image)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class Test(unittest.TestCase):
+
+    def test_gif(self):
+        data = b'GIF89a' + struct.pack(b"<HH", 320, 200)
+        self.assertEqual(getImageInfo(data), ('image/gif', 320, 200))
+
+    def test_png(self):
+        self.assertEqual(getImageInfo(png_header(1200, 800)),
+                         ('image/png', 1200, 800))
+        # truncated before the dimensions
+        self.assertEqual(getImageInfo(png_header(1200, 800)[:20])[1:],
+                         (-1, -1))
+
+    def test_jpeg(self):
+        data = jpeg_header(1500, 1000)
+        self.assertEqual(getImageInfo(data), ('image/jpeg', 1500, 1000))
+        # truncated inside the EXIF segment and inside the SOF segment
+        self.assertEqual(getImageInfo(data[:500]), ('image/jpeg', -1, -1))
+        self.assertEqual(getImageInfo(data[:1010]), ('image/jpeg', -1, -1))
+
+    def test_webp(self):
+        vp8 = b'RIFF' + b'\x00' * 4 + b'WEBPVP8 ' + b'\x00' * 10 + \
+            struct.pack(b"<HH", 800, 600)
+        self.assertEqual(getImageInfo(vp8), ('image/webp', 800, 600))
+
+        bits = (400 - 1) | ((300 - 1) << 14)
+        vp8l = b'RIFF' + b'\x00' * 4 + b'WEBPVP8L' + b'\x00' * 5 + \
+            struct.pack(b"<L", bits)
+        self.assertEqual(getImageInfo(vp8l), ('image/webp', 400, 300))
+
+        vp8x = b'RIFF' + b'\x00' * 4 + b'WEBPVP8X' + b'\x00' * 8 + \
+            (1999).to_bytes(3, "little") + (999).to_bytes(3, "little")
+        self.assertEqual(getImageInfo(vp8x), ('image/webp', 2000, 1000))
+
+    def test_probe(self):
+        server = HTTPServer(("127.0.0.1", 0), ImageHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/cover.png".format(server.server_port)
+        ImageHandler.requests = []
+        coverarthandler.dimensions.clear()
+
+        try:
+            self.assertEqual(probe_image_size(url), (640, 480))
+            self.assertEqual(probe_image_size(url), (640, 480))
+            self.assertEqual(len(ImageHandler.requests), 1)
+            self.assertTrue(ImageHandler.requests[0].startswith("bytes=0-"))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_probe_failed(self):
+        server = HTTPServer(("127.0.0.1", 0), ImageHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/broken.png".format(server.server_port)
+        ImageHandler.requests = []
+        coverarthandler.dimensions.clear()
+        coverarthandler.failed_probes.clear()
+
+        try:
+            self.assertEqual(probe_image_size(url), (0, 0))
+            self.assertEqual(probe_image_size(url), (0, 0))
+            self.assertEqual(len(ImageHandler.requests), 1)
+            self.assertNotIn(url, coverarthandler.dimensions)
+
+            # Failures are probed again after PROBE_ERROR_TTL
+            coverarthandler.failed_probes.clear()
+            self.assertEqual(probe_image_size(url), (0, 0))
+            self.assertEqual(len(ImageHandler.requests), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
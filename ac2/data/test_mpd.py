@@ -0,0 +1,76 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import unittest
+import tempfile
+import os
+
+from ac2.data.mpd import CoverIndex, find_cover
+
+
+class Test(unittest.TestCase):
+
+    def test_find_cover(self):
+        self.assertEqual(find_cover(["a.mp3", "Folder.jpg", "cover.png"]),
+                         "cover.png")
+        self.assertEqual(find_cover(["FRONT.JPEG", "folder.gif"]),
+                         "FRONT.JPEG")
+        self.assertIsNone(find_cover(["a.mp3", "coverx.jpg"]))
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as base:
+            os.makedirs(os.path.join(base, "artist", "album"))
+            for f in ["artist/album/01.flac", "artist/album/cover.jpg",
+                      "artist/02.flac"]:
+                open(os.path.join(base, f), "w").close()
+
+            indexfile = os.path.join(base, "index.json")
+            index = CoverIndex(base, indexfile)
+            index.build()
+
+            self.assertEqual(index.lookup("artist/album/01.flac"),
+                             os.path.join(base, "artist/album/cover.jpg"))
+            self.assertIsNone(index.lookup("artist/02.flac"))
+            self.assertIsNone(index.lookup("unknown/03.flac"))
+
+            # Directories without a cover are checked again, but only once
+            # per refresh interval
+            index.lookup("artist/02.flac")
+            self.assertEqual(index.refresh_queue.get_nowait(), "artist")
+            self.assertEqual(index.refresh_queue.get_nowait(), "unknown")
+            self.assertTrue(index.refresh_queue.empty())
+
+            # A new cover is found after updating its directory
+            open(os.path.join(base, "artist", "folder.png"), "w").close()
+            index.update_directory(os.path.join(base, "artist"))
+            self.assertEqual(index.lookup("artist/02.flac"),
+                             os.path.join(base, "artist/folder.png"))
+
+            # The index is persistent
+            index.save()
+            index = CoverIndex(base, indexfile)
+            self.assertTrue(index.loaded)
+            self.assertEqual(index.lookup("artist/02.flac"),
+                             os.path.join(base, "artist/folder.png"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import copy
+import timeit
+import tracemalloc
+
+from ac2.metadata import Metadata
+
+
+class DictMetadata():
+    """
+    Metadata with the same attributes stored in __dict__ as it has been
+    implemented before, only used for comparison
+    """
+
+    def __init__(self, md):
+        for attrib in Metadata.__slots__:
+            setattr(self, attrib, getattr(md, attrib))
+
+
+def allocated(create, count):
+    tracemalloc.start()
+    objects = [create() for _i in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return size / count
+
+
+def main(count=10000):
+    md = Metadata(artist="Aldous Harding", title="The Barrel",
+                  albumTitle="Designer", playerName="dummy",
+                  playerState="playing")
+    legacy = DictMetadata(md)
+
+    print("bytes per copy: slots {:.0f}, dict {:.0f}".format(
+        allocated(md.copy, count),
+        allocated(lambda: copy.copy(legacy), count)))
+
+    print("usec per copy: slots {:.2f}, dict {:.2f}".format(
+        timeit.timeit(md.copy, number=count) * 1000000 / count,
+        timeit.timeit(lambda: copy.copy(legacy), number=count) * 1000000 / count))
+
+    other = md.copy()
+    other.artUrl = "http://example.com/cover.jpg"
+    print("usec per diff: {:.2f}".format(
+        timeit.timeit(lambda: other.diff(md), number=count) * 1000000 / count))
+
+
+if __name__ == "__main__":
+    main()
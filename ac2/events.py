@@ -0,0 +1,148 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+'''
+Distribution of events (metadata, playback state, volume) to streaming
+clients
+'''
+
+import threading
+import json
+import logging
+import copy
+
+EVENT_METADATA = "metadata"
+EVENT_STATE = "state"
+EVENT_VOLUME = "volume"
+
+
+class EventSubscriber():
+    """
+    Pending events of a single client. Events of the same type are
+    coalesced if the client doesn't read them fast enough: metadata
+    changes are merged, for state and volume only the latest value is
+    kept. Memory use per client is therefore bounded.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.order = []
+        self.closed = False
+        self.coalesced = 0
+
+    def put(self, event, data):
+        with self.condition:
+            if event in self.pending:
+                self.coalesced += 1
+                if event == EVENT_METADATA:
+                    self.pending[event].update(data)
+                else:
+                    self.pending[event] = data
+            else:
+                self.pending[event] = dict(data)
+                self.order.append(event)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Returns the next (event, data) tuple or None if there was no event
+        within the timeout
+        """
+        with self.condition:
+            if len(self.order) == 0 and not self.closed:
+                self.condition.wait(timeout)
+            if len(self.order) == 0:
+                return None
+            event = self.order.pop(0)
+            return (event, self.pending.pop(event))
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class EventBroker():
+    """
+    Publishes events to all subscribers. New subscribers receive the
+    current metadata, state and volume first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.current = {}
+
+    def subscribe(self):
+        subscriber = EventSubscriber()
+        with self.lock:
+            for event in [EVENT_METADATA, EVENT_STATE, EVENT_VOLUME]:
+                if event in self.current:
+                    subscriber.put(event, self.current[event])
+            self.subscribers.append(subscriber)
+        logging.debug("new event subscriber, %s subscribers",
+                      len(self.subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def publish(self, event, data):
+        """
+        Send an event to all subscribers. Metadata events only contain the
+        attributes that changed since the last metadata event.
+        """
+        with self.lock:
+            if event == EVENT_METADATA:
+                previous = self.current.get(event, {})
+                changes = {k: v for k, v in data.items()
+                           if k not in previous or previous[k] != v}
+                self.current[event] = copy.deepcopy(data)
+                data = changes
+            else:
+                if self.current.get(event) == data:
+                    return
+                self.current[event] = data
+
+            if len(data) == 0:
+                return
+
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            subscriber.put(event, data)
+
+    def subscriber_count(self):
+        with self.lock:
+            return len(self.subscribers)
+
+
+def format_event(event, data):
+    """
+    Format an event as a Server-Sent Events message
+    """
+    return "event: {}\ndata: {}\n\n".format(event,
+                                            json.dumps(data, skipkeys=True))
@@ -20,10 +20,11 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
-import copy
+import heapq
 import threading
 import logging
 from time import time 
+from concurrent.futures import ThreadPoolExecutor
 
 from expiringdict import ExpiringDict
 
@@ -33,6 +34,7 @@ import ac2.data.fanarttv as fanarttv
 import ac2.data.hifiberry as hifiberrydb
 import ac2.data.coverartarchive as coverartarchive
 from ac2.data.identities import host_uuid
+from ac2.data.coverarthandler import best_picture
 from ac2.data.guess import guess_order, guess_stream_order, \
     ORDER_ARTIST_TITLE, ORDER_TITLE_ARTIST, ORDER_ARTIST_TITLE
 from ac2.constants import STATE_PLAYING
@@ -45,8 +47,19 @@ order_cache = ExpiringDict(max_len=10, max_age_seconds=3600)
 class Metadata:
     """
     Class to start metadata of a song
+    
+    Attributes are stored in slots, metadata objects are copied for every 
+    display and this keeps copies small and fast.
     """
 
+    __slots__ = ("artist", "title", "albumArtist", "albumTitle", "artUrl",
+                 "externalArtUrl", "discNumber", "tracknumber", "playerName",
+                 "playerState", "streamUrl", "playCount", "mbid", "artistmbid",
+                 "albummbid", "loved", "wiki", "loveSupported", "tags",
+                 "skipped", "host_uuid", "releaseDate", "trackid", "trackId",
+                 "hifiberry_cover_found", "duration", "time", "position",
+                 "positionupdate")
+
     loveSupportedDefault = False
 
     def __init__(self, artist=None, title=None,
@@ -78,6 +91,8 @@ class Metadata:
         self.host_uuid = None
         self.releaseDate = None
         self.trackid = None
+        # Same as trackid, clients use this key of the MPRIS players
+        self.trackId = None
         self.hifiberry_cover_found=False
         self.duration=0
         self.time=0
@@ -175,9 +190,9 @@ class Metadata:
 
 
     def fill_undefined(self, metadata):
-        for attrib in metadata.__dict__:
-            if attrib in self.__dict__ and self.__dict__[attrib] is None:
-                self.__dict__[attrib] = metadata.__dict__[attrib]
+        for attrib in Metadata.__slots__:
+            if getattr(self, attrib) is None:
+                setattr(self, attrib, getattr(metadata, attrib))
 
     def add_tag(self, tag):
         tag = tag.lower().replace("-", " ")
@@ -185,7 +200,66 @@ class Metadata:
             self.tags.append(tag)
 
     def copy(self):
-        return copy.copy(self)
+        # Explicit assignments are much faster than a loop over __slots__
+        md = Metadata.__new__(Metadata)
+        md.artist = self.artist
+        md.title = self.title
+        md.albumArtist = self.albumArtist
+        md.albumTitle = self.albumTitle
+        md.artUrl = self.artUrl
+        md.externalArtUrl = self.externalArtUrl
+        md.discNumber = self.discNumber
+        md.tracknumber = self.tracknumber
+        md.playerName = self.playerName
+        md.playerState = self.playerState
+        md.streamUrl = self.streamUrl
+        md.playCount = self.playCount
+        md.mbid = self.mbid
+        md.artistmbid = self.artistmbid
+        md.albummbid = self.albummbid
+        md.loved = self.loved
+        md.wiki = self.wiki
+        md.loveSupported = self.loveSupported
+        md.skipped = self.skipped
+        md.host_uuid = self.host_uuid
+        md.releaseDate = self.releaseDate
+        md.trackid = self.trackid
+        md.trackId = self.trackId
+        md.hifiberry_cover_found = self.hifiberry_cover_found
+        md.duration = self.duration
+        md.time = self.time
+        md.position = self.position
+        md.positionupdate = self.positionupdate
+        md.tags = list(self.tags)
+        return md
+
+    def to_dict(self):
+        return {attrib: getattr(self, attrib) for attrib in Metadata.__slots__}
+
+    def diff(self, other):
+        """
+        Returns the attributes that differ from other with the values of
+        this object
+        """
+        if other is None:
+            return self.to_dict()
+
+        changes = {}
+        for attrib in Metadata.__slots__:
+            value = getattr(self, attrib)
+            if value != getattr(other, attrib):
+                changes[attrib] = value
+        return changes
+
+    def set_attributes(self, attributes):
+        """
+        Set attributes from a dictionary, unknown keys are ignored
+        """
+        for attrib in attributes:
+            if attrib in METADATA_ATTRIBUTES:
+                setattr(self, attrib, attributes[attrib])
+            else:
+                logging.debug("ignoring unknown metadata attribute %s", attrib)
 
     def is_unknown(self):
         if self.artist_unknown() or self.title_unknown():
@@ -214,63 +288,409 @@ class Metadata:
                                                 self.albumTitle, self.artUrl)
 
 
-def enrich_metadata(metadata, callback=None):
+METADATA_ATTRIBUTES = frozenset(Metadata.__slots__)
+
+
+class EnrichmentStage():
     """
-    Add more metadata to a song based on the information that are already
-    given. These will be retrieved from external sources.
+    A single step of the metadata enrichment pipeline
+
+    A stage runs when all its dependencies are finished. If one of the
+    attributes in "requires" is still undefined at this point, it will
+    also wait for the "fallback" stages that might deliver it.
     """
-    songId = metadata.songId()
 
-    if external_metadata:
+    def __init__(self, name, function, dependencies=[], requires=[],
+                 fallback=[]):
+        self.name = name
+        self.function = function
+        self.dependencies = dependencies
+        self.requires = requires
+        self.fallback = fallback
 
-        metadata.host_uuid = host_uuid()
-        
-        # Try musicbrainzs first
-        try:
-            musicbrainz.enrich_metadata(metadata)
-        except Exception as e:
-            logging.warning("error when retrieving data from musicbrainz")
-            logging.exception(e)
-            
-        # Then HiFiBerry MusicDB
-        try:
-            hifiberrydb.enrich_metadata(metadata)
-        except Exception as e:
-            logging.warning("error when retrieving data from hifiberry db")
-            logging.exception(e)
+    def is_ready(self, metadata, finished, stage_names):
+        for d in self.dependencies:
+            if d in stage_names and d not in finished:
+                return False
 
-        # Then Last.FM
-        try:
-            lastfmdata.enrich_metadata(metadata)
-        except Exception as e:
-            logging.warning("error when retrieving data from last.fm")
-            logging.exception(e)
-                
-        # try Fanart.TV, but without artist picture
-        try:
-            fanarttv.enrich_metadata(metadata, allow_artist_picture=False)
-        except Exception as e:
-            logging.exception(e)
-        
-        # try coverartarchive
+        for attribute in self.requires:
+            if getattr(metadata, attribute) is None:
+                for d in self.fallback:
+                    if d in stage_names and d not in finished:
+                        return False
+
+        return True
+
+    def __str__(self):
+        return self.name
+
+
+def fanarttv_album_cover(metadata):
+    fanarttv.enrich_metadata(metadata, allow_artist_picture=False)
+
+
+def fanarttv_artist_picture(metadata):
+    # still no cover? try to get at least an artist picture
+    fanarttv.enrich_metadata(metadata, allow_artist_picture=True)
+
+
+enrichment_stages = [
+    EnrichmentStage("musicbrainz", musicbrainz.enrich_metadata),
+    EnrichmentStage("lastfm", lastfmdata.enrich_metadata),
+    EnrichmentStage("hifiberry", hifiberrydb.enrich_metadata,
+                    dependencies=["musicbrainz"]),
+    EnrichmentStage("fanarttv", fanarttv_album_cover,
+                    dependencies=["musicbrainz", "hifiberry"],
+                    requires=["artistmbid"],
+                    fallback=["lastfm"]),
+    EnrichmentStage("coverartarchive", coverartarchive.enrich_metadata,
+                    dependencies=["musicbrainz", "hifiberry"],
+                    requires=["albummbid"],
+                    fallback=["lastfm"]),
+    EnrichmentStage("hifiberry update", hifiberrydb.send_update,
+                    dependencies=["lastfm", "fanarttv", "coverartarchive"]),
+    EnrichmentStage("fanarttv artist", fanarttv_artist_picture,
+                    dependencies=["hifiberry update"]),
+]
+
+# Prefetching only warms the caches, it must not report songs that haven't
+# been played to the HiFiBerry database
+prefetch_stages = [stage for stage in enrichment_stages
+                   if stage.name != "hifiberry update"]
+
+# Upper limit for a whole pipeline, the stages use HTTP timeouts
+PIPELINE_TIMEOUT = 120
+
+enrichment_executor = ThreadPoolExecutor(max_workers=6,
+                                         thread_name_prefix="enrichment")
+
+
+class EnrichmentPipeline():
+    """
+    Runs the enrichment stages concurrently. Every stage works on its own
+    copy of the metadata, results are merged back when the stage is
+    finished and reported to the callback.
+    """
+
+    def __init__(self, metadata, callback=None, stages=None,
+                 executor=None, cancelled=None):
+        self.metadata = metadata
+        self.callback = callback
+        self.songId = metadata.songId()
+        if stages is None:
+            stages = enrichment_stages
+        self.stages = stages
+        self.stage_names = set(stage.name for stage in stages)
+        if executor is None:
+            executor = enrichment_executor
+        self.executor = executor
+        self.cancelled = cancelled
+        self.lock = threading.Lock()
+        self.started = set()
+        self.finished = set()
+        self.done = threading.Event()
+
+    def is_cancelled(self):
+        return self.cancelled is not None and self.cancelled()
+
+    def run(self):
+        self.schedule()
+        if not self.done.wait(PIPELINE_TIMEOUT):
+            logging.warning("enrichment of %s not finished after %ss",
+                            self.songId, PIPELINE_TIMEOUT)
+
+    def schedule(self):
+        ready = []
+        with self.lock:
+            for stage in self.stages:
+                if stage.name in self.started:
+                    continue
+                if stage.is_ready(self.metadata, self.finished,
+                                  self.stage_names):
+                    self.started.add(stage.name)
+                    ready.append(stage)
+
+            if len(self.finished) == len(self.stages):
+                self.done.set()
+
+        for stage in ready:
+            self.executor.submit(self.run_stage, stage)
+
+    def run_stage(self, stage):
+        # Exceptions must not escape, the pipeline would never finish
+        changes = {}
         try:
-            coverartarchive.enrich_metadata(metadata)
+            with self.lock:
+                md = self.metadata.copy()
+            before = md.to_dict()
+            before["tags"] = list(md.tags)
+
+            # Remaining stages of a cancelled job are skipped
+            if not self.is_cancelled():
+                try:
+                    stage.function(md)
+                except Exception as e:
+                    logging.warning("error when retrieving data from %s", stage)
+                    logging.exception(e)
+
+                with self.lock:
+                    changes = self.merge(md, before)
         except Exception as e:
+            logging.warning("could not merge results of %s", stage)
             logging.exception(e)
-            
-        hifiberrydb.send_update(metadata)
-        
-        # still no cover? try to get at least an artist picture
+        finally:
+            with self.lock:
+                self.finished.add(stage.name)
+
         try:
-            fanarttv.enrich_metadata(metadata, allow_artist_picture=True)
+            if len(changes) > 0 and self.callback is not None \
+                    and not self.is_cancelled():
+                self.callback.update_metadata_attributes(changes,
+                                                         self.songId)
         except Exception as e:
-            logging.exception(e)
-    
+            logging.warning("could not send metadata update: %s", e)
+        finally:
+            self.schedule()
+
+    def merge(self, md, before):
+        """
+        Merge the results of a stage. An attribute that has already been
+        changed by another stage will not be overwritten, with the
+        exception of the artwork URL where the best picture wins.
+        """
+        changes = {}
+        for attribute in Metadata.__slots__:
+            value = getattr(md, attribute)
+            if value == before.get(attribute):
+                continue
+
+            if attribute == "tags":
+                for tag in value:
+                    if tag not in self.metadata.tags:
+                        self.metadata.tags.append(tag)
+                value = list(self.metadata.tags)
+            elif attribute == "externalArtUrl":
+                best = best_picture(self.songId)
+                if best is not None:
+                    value = best
+                self.metadata.externalArtUrl = value
+            elif getattr(self.metadata, attribute) == \
+                    before.get(attribute):
+                setattr(self.metadata, attribute, value)
+            else:
+                continue
+
+            changes[attribute] = value
+
+        return changes
+
+
+def enrich_metadata(metadata, callback=None, cancelled=None):
+    """
+    Add more metadata to a song based on the information that are already
+    given. These will be retrieved from external sources.
+
+    Independent sources are queried in parallel, partial results are
+    sent to the callback as soon as a source delivered them.
+    If cancelled is given, it will be called to check if the results are
+    still needed.
+    """
+    songId = metadata.songId()
+
+    if external_metadata:
+
+        metadata.host_uuid = host_uuid()
+
+        EnrichmentPipeline(metadata, callback, cancelled=cancelled).run()
+
+    if cancelled is not None and cancelled():
+        logging.debug("enrichment of %s cancelled", songId)
+        return
+
     if callback is not None:
-        callback.update_metadata_attributes(metadata.__dict__, songId)
+        callback.update_metadata_attributes(metadata.to_dict(), songId)
+
+
+def prefetch_metadata(metadata, _callback=None, cancelled=None):
+    """
+    Retrieve external metadata for a song that hasn't been played yet.
+    Results are not reported.
+    """
+    if external_metadata:
+        EnrichmentPipeline(metadata, stages=prefetch_stages,
+                           cancelled=cancelled).run()
+
+
+# Jobs for the current song run before prefetch jobs for upcoming songs
+PRIORITY_CURRENT = 0
+PRIORITY_PREFETCH = 1
+
+
+class EnrichmentJob():
+
+    def __init__(self, metadata, callback, sequence,
+                 priority=PRIORITY_CURRENT):
+        self.metadata = metadata
+        self.callback = callback
+        self.songId = metadata.songId()
+        self.sequence = sequence
+        self.priority = priority
+        self.cancelled = False
+        self.started = False
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < \
+            (other.priority, other.sequence)
+
+
+class EnrichmentScheduler():
+    """
+    Runs enrichment jobs in a limited number of background threads.
+
+    There is at most one job per song. If a new song is submitted, jobs
+    for other songs are cancelled as nobody is listening to these
+    anymore. Prefetch jobs for upcoming songs only fill the caches, they
+    run with a lower priority. Prefetch jobs that haven't been started yet
+    are cancelled by song changes, the controller will submit new ones for
+    the songs following the new one.
+    """
+
+    def __init__(self, max_jobs=2, function=None, prefetch_function=None):
+        self.max_jobs = max_jobs
+        if function is None:
+            function = enrich_metadata
+        self.function = function
+        if prefetch_function is None:
+            prefetch_function = prefetch_metadata
+        self.prefetch_function = prefetch_function
+        self.condition = threading.Condition()
+        self.queue = []
+        self.jobs = {}
+        self.workers = []
+        self.sequence = 0
+        self.stats = {
+            "started": 0,
+            "cancelled": 0,
+            "deduped": 0,
+            "completed": 0,
+            "prefetched": 0,
+        }
+
+    def submit(self, metadata, callback=None, priority=PRIORITY_CURRENT):
+        songId = metadata.songId()
+        with self.condition:
+            job = self.jobs.get(songId)
+            if job is not None and not job.cancelled and \
+                    priority >= job.priority:
+                logging.debug("enrichment of %s already scheduled", songId)
+                self.stats["deduped"] += 1
+                return job
+
+            if priority == PRIORITY_CURRENT:
+                for other in self.jobs.values():
+                    if other.cancelled or other is job:
+                        continue
+                    if other.priority == PRIORITY_CURRENT or \
+                            not other.started:
+                        logging.debug("cancelling enrichment of %s",
+                                      other.songId)
+                        other.cancelled = True
+                        self.stats["cancelled"] += 1
+            else:
+                self.stats["prefetched"] += 1
+
+            if job is not None and not job.cancelled and not job.started:
+                # The song became current before its prefetch started
+                logging.debug("raising priority of %s", songId)
+                job.priority = priority
+                job.callback = callback
+                heapq.heapify(self.queue)
+                self.stats["deduped"] += 1
+                self.condition.notify()
+                return job
+            # A running prefetch has no callback, start a new job, it will
+            # be fast as the caches are warm
+
+            self.sequence += 1
+            job = EnrichmentJob(metadata.copy(), callback, self.sequence,
+                                priority)
+            self.jobs[songId] = job
+            heapq.heappush(self.queue, job)
+
+            self.workers = [w for w in self.workers if w.is_alive()]
+            if len(self.workers) < self.max_jobs:
+                worker = threading.Thread(target=self.worker,
+                                          name="enrichment scheduler")
+                worker.daemon = True
+                self.workers.append(worker)
+                worker.start()
+
+            self.condition.notify()
+            return job
+
+    def worker(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0:
+                    self.condition.wait()
+                job = heapq.heappop(self.queue)
+                if job.cancelled:
+                    self.finish(job)
+                    continue
+                job.started = True
+                self.stats["started"] += 1
+
+            if job.priority == PRIORITY_PREFETCH:
+                function = self.prefetch_function
+            else:
+                function = self.function
+
+            try:
+                function(job.metadata, job.callback,
+                         cancelled=job.is_cancelled)
+            except Exception as e:
+                logging.warning("enrichment of %s failed", job.songId)
+                logging.exception(e)
+
+            with self.condition:
+                if not job.cancelled:
+                    self.stats["completed"] += 1
+                self.finish(job)
+
+    def finish(self, job):
+        if self.jobs.get(job.songId) is job:
+            del self.jobs[job.songId]
+
+    def statistics(self):
+        """
+        Returns the number of started, cancelled, deduplicated,
+        completed and prefetch enrichment jobs
+        """
+        with self.condition:
+            return dict(self.stats)
+
+
+enrichment_scheduler = EnrichmentScheduler()
+
 
- 
 def enrich_metadata_bg(metadata, callback):
-    md = metadata.copy()
-    threading.Thread(target=enrich_metadata, args=(md, callback)).start()
+    enrichment_scheduler.submit(metadata, callback)
+
+
+def enrichment_statistics():
+    return enrichment_scheduler.statistics()
 
+
+def prefetch_metadata_bg(metadata_list):
+    """
+    Retrieve external metadata for upcoming songs in the background. The
+    results are not reported, but HTTP and cover caches are ready when
+    the song starts playing.
+    """
+    for metadata in metadata_list:
+        if metadata is None or metadata.is_unknown():
+            continue
+        enrichment_scheduler.submit(metadata, None, PRIORITY_PREFETCH)
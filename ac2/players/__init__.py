@@ -51,6 +51,35 @@ class PlayerControl:
     """
     def get_supported_commands(self):
         return []
+    
+    def upcoming(self, count=2):
+        """
+        Return metadata of the next songs in the queue, if the player
+        knows these
+        """
+        return []
+    
+    def is_event_driven(self):
+        """
+        True if the player calls the update listener on every change and
+        doesn't need to be polled
+        """
+        return False
+    
+    def set_update_listener(self, listener):
+        """
+        Register a function that is called with the player name when the
+        player reports a change by itself (instead of being polled)
+        """
+        self.update_listener = listener
+        
+    def notify_update(self):
+        listener = getattr(self, "update_listener", None)
+        if listener is not None:
+            try:
+                listener(self.playername)
+            except Exception as e:
+                logging.warning("update listener failed: %s", e)
         
         
         
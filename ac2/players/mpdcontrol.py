@@ -21,8 +21,10 @@ SOFTWARE.
 '''
 
 import logging
+import threading
+import time
 
-from mpd import MPDClient
+from mpd import MPDClient, ConnectionError as MPDConnectionError
 
 from ac2.helpers import map_attributes
 from ac2.players import PlayerControl
@@ -54,12 +56,128 @@ STATE_MAP={
     MPD_STATE_STOPPED: STATE_STOPPED
 }
 
+# Subsystems that change what the controller displays
+MPD_IDLE_SUBSYSTEMS=["player", "mixer", "options", "playlist"]
+
+    
+
+def query_status(client, playlist=False):
+    """
+    Retrieve status, current song and optionally the playlist in a single
+    round trip using an MPD command list
+    """
+    client.command_list_ok_begin()
+    client.status()
+    client.currentsong()
+    if playlist:
+        client.playlistinfo()
+    res = client.command_list_end()
+    
+    status = res[0]
+    song = None
+    if status.get("state") in [MPD_STATE_PLAY, MPD_STATE_PAUSE]:
+        song = res[1]
+        
+    if playlist:
+        return status, song, res[2]
+    else:
+        return status, song
+
+
+class MPDConnection():
+    """
+    A single MPD connection that is reconnected on demand. Failing
+    reconnects are delayed with an exponential backoff.
+    """
+    
+    def __init__(self, host, port, timeout, name="mpd",
+                 min_retry_delay=1, max_retry_delay=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.name = name
+        self.client = None
+        self.lock = threading.RLock()
+        self.min_retry_delay = min_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.retry_delay = min_retry_delay
+        self.next_retry = 0
+        
+    def connect(self):
+        if self.client is not None:
+            return self.client
+        
+        if time.monotonic() < self.next_retry:
+            return None
+        
+        client = MPDClient()
+        client.timeout = self.timeout
+        try:
+            client.connect(self.host, self.port)
+            logging.info("Connected %s connection to %s:%s",
+                         self.name, self.host, self.port)
+            self.client = client
+            self.retry_delay = self.min_retry_delay
+        except Exception as e:
+            logging.debug("can't connect %s connection to %s:%s: %s, retrying in %ss",
+                          self.name, self.host, self.port, e, self.retry_delay)
+            self.next_retry = time.monotonic() + self.retry_delay
+            self.retry_delay = min(self.retry_delay * 2, self.max_retry_delay)
+            
+        return self.client
+        
+    def disconnect(self):
+        if self.client is None:
+            return
+        
+        try:
+            self.client.close()
+            self.client.disconnect()
+        except:
+            pass
+        
+        self.client = None
+        
+    def execute(self, function):
+        """
+        Run function(client) on this connection. Returns None if MPD can't
+        be reached.
+        
+        MPD closes connections that have been idle for some time 
+        (connection_timeout), in this case the function is retried once 
+        on a new connection.
+        """
+        with self.lock:
+            for retry in [False, True]:
+                client = self.connect()
+                if client is None:
+                    return None
+                
+                try:
+                    return function(client)
+                except TimeoutError as e:
+                    logging.debug("MPD %s connection timed out: %s", 
+                                  self.name, e)
+                    self.disconnect()
+                    return None
+                except (MPDConnectionError, OSError) as e:
+                    logging.debug("MPD %s connection lost: %s", self.name, e)
+                    self.disconnect()
+                    if retry:
+                        return None
+                except Exception as e:
+                    # Connection to MPD might be broken, reconnect on next use
+                    logging.debug("MPD %s connection failed: %s", self.name, e)
+                    self.disconnect()
+                    return None
+            
+    def is_connected(self):
+        return self.client is not None
     
 
 class MPDControl(PlayerControl):
     
     def __init__(self, args={}):
-        self.client=None
         self.playername="MPD"
         if "port" in args:
             self.port=args["port"]
@@ -76,38 +194,78 @@ class MPDControl(PlayerControl):
         else:
             self.timeout=5
             
+        self.idle=args.get("idle", True)
+        self.listener=None
+        
+        # State and metadata as reported by the idle listener
+        self.snapshot_lock=threading.Lock()
+        self.cached_state=None
+        self.cached_metadata=None
+        
+        # Polling and commands use separate connections, commands
+        # don't have to wait for status updates
+        self.connection = MPDConnection(self.host, self.port, 
+                                        self.timeout, "status")
+        self.command_connection = MPDConnection(self.host, self.port, 
+                                                self.timeout, "command")
+            
         self.connect()
 
         
     def start(self):
-        # No threading implemented
-        pass
-    
+        if self.idle:
+            self.listener = MPDIdleListener(self)
+            self.listener.start()
+            
+    def has_snapshot(self):
+        return self.listener is not None and self.listener.connected \
+            and self.cached_state is not None
+            
+    def is_event_driven(self):
+        return self.has_snapshot()
+            
+    def update_snapshot(self, status, song):
+        state = self.state_from_status(status)
+        md = self.metadata_from_song(song)
+        with self.snapshot_lock:
+            changed = (state != self.cached_state) or \
+                self.cached_metadata is None or \
+                len(md.diff(self.cached_metadata)) > 0
+            self.cached_state = state
+            self.cached_metadata = md
+            
+        return changed
     
-    def connect(self):
-        if self.client is not None:
-            return self.client
-        
-        self.client = MPDClient()
-        self.client.timeout = self.timeout
+    def clear_snapshot(self):
+        with self.snapshot_lock:
+            self.cached_state = None
+            self.cached_metadata = None
+            
+    def state_from_status(self, status):
         try:
-            self.client.connect(self.host, self.port)
-            logging.info("Connected to %s:%s",self.host, self.port)
+            return STATE_MAP[status["state"]]
         except:
-            self.client=None
-        
+            return STATE_UNDEF
+            
+    def metadata_from_song(self, song):
+        md = Metadata()
+        md.playerName = "mpd"
         
-    def disconnect(self):
-        if self.client is None:
-            return
+        if song is not None:
+            attributes = {}
+            map_attributes(song, attributes, MPD_ATTRIBUTE_MAP)
+            md.set_attributes(attributes)
+            
+        return md
+    
+    
+    def connect(self):
+        return self.connection.connect()
         
-        try:
-            self.client.close()
-            self.client.disconnect()
-        except:
-            pass
         
-        self.client=None
+    def disconnect(self):
+        self.connection.disconnect()
+        self.command_connection.disconnect()
         
     def get_supported_commands(self):
         return [CMD_NEXT, CMD_PREV, CMD_PAUSE, CMD_PLAYPAUSE, CMD_STOP, CMD_PLAY, CMD_SEEK,
@@ -115,87 +273,102 @@ class MPDControl(PlayerControl):
             
     
     def get_state(self):
-        if self.client is None:
-            self.connect()
-
-        if self.client is None:
-            return {}
+        if self.has_snapshot():
+            return self.cached_state
         
-        try:
-            status=self.client.status()
-        except:
-            # Connection to MPD might be broken
-            self.disconnect()
-            self.connect()
-    
+        status = self.connection.execute(lambda client: client.status())
+        if status is None:
+            return STATE_UNDEF
         
-        try:
-            state = STATE_MAP[status["state"]]
-        except:
-            state = STATE_UNDEF
-            
-        return state
+        return self.state_from_status(status)
     
         
     def get_meta(self):
-        state=self.get_state()
+        if self.has_snapshot():
+            with self.snapshot_lock:
+                return self.cached_metadata.copy()
+            
+        res = self.connection.execute(query_status)
+        if res is None:
+            return self.metadata_from_song(None)
         
-        song = None
-        if state in [STATE_PLAYING,STATE_PAUSED]:
-            song=self.client.currentsong()
-             
-        md = Metadata()
-        md.playerName = "mpd"
+        (_status, song) = res
+        return self.metadata_from_song(song)
+    
+    def upcoming(self, count=2):
+        """
+        Metadata of the next songs in the queue based on status.nextsong,
+        this takes random mode into account for the first song
+        """
+        def query_upcoming(client):
+            status = client.status()
+            if "nextsong" not in status:
+                return []
+            
+            start = int(status["nextsong"])
+            return client.playlistinfo("{}:{}".format(start, start + count))
         
-        if song is not None:
-            map_attributes(song, md.__dict__,MPD_ATTRIBUTE_MAP)
+        songs = self.connection.execute(query_upcoming)
+        if songs is None:
+            return []
         
-        return md
+        return [self.metadata_from_song(song) for song in songs]
     
     def send_command(self,command, parameters={}):
         if command not in self.get_supported_commands():
             return False 
         
-        if self.client is None:
-            self.reconnect()
-
-        if self.client is None:
+        res = self.command_connection.execute(
+            lambda client: self.execute_command(client, command))
+        if res is None:
             return False
         
+        return res
+    
+    def execute_command(self, client, command):
         playstate=None
         if command in [CMD_PLAY, CMD_PLAYPAUSE]:
-            playstate=self.get_state()
+            # The command depends on the current state. MPD command lists 
+            # can't contain conditions, so without a snapshot from the idle
+            # listener the state is retrieved in a separate round trip.
+            if self.has_snapshot():
+                playstate=self.cached_state
+            else:
+                playstate=self.state_from_status(client.status())
         
         if command == CMD_NEXT:
-            self.client.next()
+            client.next()
         elif command == CMD_PREV:
-            self.client.previous()
+            client.previous()
         elif command == CMD_PAUSE:
-            self.client.pause(1)
+            client.pause(1)
         elif command == CMD_STOP:
-            self.client.stop()
+            client.stop()
         elif command == CMD_RANDOM:
-            self.client.random(1)
+            client.random(1)
         elif command == CMD_NORANDOM:
-            self.client.random(0)
+            client.random(0)
         elif command == CMD_REPEAT_ALL:
-            self.client.repeat(1)
+            client.repeat(1)
         elif command == CMD_REPEAT_NONE:
-            self.client.repeat(0)
-        elif command == CMD_REPEAT_ALL:
-            self.client.repeat(1)
+            client.repeat(0)
         elif command == CMD_PLAY:
             if playstate == STATE_PAUSED:
-                self.client.pause(0)
+                client.pause(0)
             else:
-                self.client.play(0)
+                client.play(0)
         elif command == CMD_PLAYPAUSE:
             if playstate == STATE_PLAYING:
-                self.client.pause(1)
+                client.pause(1)
+            elif playstate == STATE_PAUSED:
+                client.pause(0)
             else:
-                self.send_command(CMD_PLAY)
+                client.play(0)
         else:
             logging.warning("command %s not implemented", command)
+            return False
+        
+        return True
             
         
     """
@@ -203,5 +376,54 @@ class MPDControl(PlayerControl):
     state. This does NOT mean this player is running
     """
     def is_active(self):
-        return self.client is not None
-    
\ No newline at end of file
+        return self.connection.is_connected() or self.has_snapshot()
+    
+    
+class MPDIdleListener(threading.Thread):
+    """
+    Waits on a dedicated MPD connection for changes and updates the
+    state/metadata snapshot of the MPDControl. The controller is notified
+    only if something changed.
+    """
+    
+    def __init__(self, control, retry_delay=5):
+        super().__init__()
+        self.daemon = True
+        self.control = control
+        self.retry_delay = retry_delay
+        self.connected = False
+        self.finished = False
+        
+    def run(self):
+        while not(self.finished):
+            client = MPDClient()
+            client.timeout = self.control.timeout
+            # idle blocks until MPD reports a change
+            client.idletimeout = None
+            try:
+                client.connect(self.control.host, self.control.port)
+                logging.info("MPD idle listener connected to %s:%s",
+                             self.control.host, self.control.port)
+                self.refresh(client)
+                self.connected = True
+                
+                while not(self.finished):
+                    changed = client.idle(*MPD_IDLE_SUBSYSTEMS)
+                    logging.debug("MPD reported changes in %s", changed)
+                    self.refresh(client)
+            except Exception as e:
+                logging.debug("MPD idle connection failed: %s", e)
+                
+            self.connected = False
+            self.control.clear_snapshot()
+            try:
+                client.disconnect()
+            except:
+                pass
+            
+            time.sleep(self.retry_delay)
+            
+    def refresh(self, client):
+        (status, song) = query_status(client)
+        if self.control.update_snapshot(status, song):
+            self.control.notify_update()
@@ -20,10 +20,13 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
-import dbus
+import time
+import threading
 import logging
-from ac2.metadata import Metadata
 
+import dbus
+
+from ac2.metadata import Metadata
 from ac2.constants import CMD_NEXT, CMD_PAUSE, CMD_PLAY, CMD_PLAYPAUSE, CMD_PREV, CMD_STOP
 from ac2.helpers import array_to_string
 
@@ -33,45 +36,297 @@ mpris_commands = [CMD_NEXT, CMD_PREV,
 
 
 MPRIS_PREFIX = "org.mpris.MediaPlayer2."
+MPRIS_PATH = "/org/mpris/MediaPlayer2"
+MPRIS_PLAYER_INTERFACE = "org.mpris.MediaPlayer2.Player"
+DBUS_PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+
+
+class MPRISPlayerCache():
+    """
+    In-memory copy of the properties of an MPRIS player.
+    It is updated by PropertiesChanged signals and, if a player does not
+    send signals, by polling
+    """
+
+    def __init__(self):
+        self.properties = {}
+        self.polled = 0  # last time all properties have been retrieved
+        self.signals = False  # did this player ever send a signal?
 
 
 class MPRIS():
-    
+
     def __init__(self):
-        self.bus=None
-           
+        self.bus = None
+        self.listener_bus = None
+        self.listening = False
+        self.player_cache = {}
+        self.owners = {}  # unique bus name -> well-known name
+        self.cache_lock = threading.Lock()
+        # Players that don't send signals are polled if the cached
+        # data are older than this
+        self.poll_interval = 0.5
+        # Players that send signals are polled only from time to time
+        # to make sure we don't miss anything
+        self.signal_refresh_interval = 60
+        self.change_callback = None
+        # D-Bus interfaces by bus name and interface name
+        self.interface_cache = {}
+        self.interface_stats = {"hits": 0, "misses": 0, "invalidated": 0}
+
     def connect_dbus(self):
         self.bus = dbus.SystemBus()
-        self.device_prop_interfaces = {}
+        self.interface_cache = {}
+
+    def start_listener(self):
+        """
+        Listen to PropertiesChanged and NameOwnerChanged signals. Once the
+        listener is running, state and metadata of players that send
+        signals are read from memory.
+        """
+        try:
+            from dbus.mainloop.glib import DBusGMainLoop, threads_init
+            from gi.repository import GLib
+        except ImportError as e:
+            logging.warning("GLib main loop not available, "
+                            "using MPRIS polling only (%s)", e)
+            return False
+
+        try:
+            threads_init()
+            self.listener_bus = dbus.SystemBus(mainloop=DBusGMainLoop(),
+                                               private=True)
+            self.listener_bus.add_signal_receiver(
+                self.properties_changed,
+                signal_name="PropertiesChanged",
+                dbus_interface=DBUS_PROPERTIES_INTERFACE,
+                path=MPRIS_PATH,
+                sender_keyword="sender")
+            self.listener_bus.add_signal_receiver(
+                self.name_owner_changed,
+                signal_name="NameOwnerChanged",
+                dbus_interface="org.freedesktop.DBus",
+                bus_name="org.freedesktop.DBus")
+            self.update_owners()
+        except Exception as e:
+            logging.warning("can't listen to MPRIS signals, "
+                            "using MPRIS polling only (%s)", e)
+            return False
+
+        loop = GLib.MainLoop()
+        thread = threading.Thread(target=loop.run, name="mpris listener")
+        thread.daemon = True
+        thread.start()
+        self.listening = True
+        logging.info("listening to MPRIS signals")
+        return True
+
+    def update_owners(self):
+        owners = {}
+        for name in self.bus.list_names():
+            if name.startswith(MPRIS_PREFIX):
+                try:
+                    owners[str(self.bus.get_name_owner(name))] = str(name)
+                except dbus.exceptions.DBusException:
+                    # Player disappeared in the meantime
+                    pass
+
+        with self.cache_lock:
+            self.owners = owners
+
+    def properties_changed(self, interface, changed, invalidated,
+                           sender=None):
+        if interface != MPRIS_PLAYER_INTERFACE:
+            return
+
+        name = self.owners.get(sender)
+        if name is None:
+            self.update_owners()
+            name = self.owners.get(sender)
+            if name is None:
+                logging.debug("PropertiesChanged from unknown sender %s",
+                              sender)
+                return
+
+        with self.cache_lock:
+            entry = self.player_cache.get(name)
+            if entry is None:
+                entry = MPRISPlayerCache()
+                self.player_cache[name] = entry
+            entry.properties.update(changed)
+            for p in invalidated:
+                entry.properties.pop(p, None)
+            if len(invalidated) > 0:
+                # Invalidated properties have to be retrieved again
+                entry.polled = 0
+            entry.signals = True
+
+        logging.debug("MPRIS properties of %s changed: %s",
+                      name, list(changed.keys()))
+        self.notify_change(name)
+
+    def name_owner_changed(self, name, old_owner, new_owner):
+        if not name.startswith(MPRIS_PREFIX):
+            return
+
+        name = str(name)
+        with self.cache_lock:
+            if old_owner:
+                self.owners.pop(str(old_owner), None)
+            if new_owner:
+                self.owners[str(new_owner)] = name
+            self.player_cache.pop(name, None)
+        self.invalidate_interfaces(name)
+
+        logging.debug("MPRIS player %s changed owner %s -> %s",
+                      name, old_owner, new_owner)
+        self.notify_change(name)
+
+    def notify_change(self, name):
+        if self.change_callback is not None:
+            try:
+                self.change_callback(name)
+            except Exception as e:
+                logging.warning("exception %s in MPRIS change callback", e)
+
+    def get_interface(self, name, interface):
+        """
+        Return a D-Bus interface of the given player. Proxies are
+        introspected only once and reused until the player disappears.
+        """
+        with self.cache_lock:
+            interfaces = self.interface_cache.get(name, {})
+            if interface in interfaces:
+                self.interface_stats["hits"] += 1
+                return interfaces[interface]
+            self.interface_stats["misses"] += 1
+            # The proxy object itself is stored with the key None
+            proxy = interfaces.get(None)
+
+        if proxy is None:
+            proxy = self.bus.get_object(name, MPRIS_PATH)
+        dbus_interface = dbus.Interface(proxy, dbus_interface=interface)
+
+        with self.cache_lock:
+            interfaces = self.interface_cache.setdefault(name, {})
+            interfaces[None] = proxy
+            interfaces[interface] = dbus_interface
+
+        return dbus_interface
+
+    def invalidate_interfaces(self, name):
+        with self.cache_lock:
+            if self.interface_cache.pop(name, None) is not None:
+                self.interface_stats["invalidated"] += 1
+                logging.debug("removed cached D-Bus proxy for %s", name)
+
+    def get_interface_stats(self):
+        """
+        Return hit/miss counters of the D-Bus proxy cache
+        """
+        with self.cache_lock:
+            return dict(self.interface_stats)
 
     def dbus_get_device_prop_interface(self, name):
-        proxy = self.bus.get_object(name, "/org/mpris/MediaPlayer2")
-        device_prop = dbus.Interface(
-            proxy, "org.freedesktop.DBus.Properties")
-        return device_prop
-    
+        return self.get_interface(name, DBUS_PROPERTIES_INTERFACE)
+
     def retrieve_players(self):
         """
         Returns a list of all MPRIS enabled players that are active in
         the system
         """
+        if self.listening:
+            with self.cache_lock:
+                return list(self.owners.values())
+
         return [name for name in self.bus.list_names()
                 if name.startswith("org.mpris")]
-        
-        
+
+    def sends_signals(self, name):
+        """
+        Check if changes of this player are reported by signals, players
+        that never sent a signal have to be polled
+        """
+        if not self.listening:
+            return False
+
+        with self.cache_lock:
+            entry = self.player_cache.get(name)
+            return entry is not None and entry.signals
+
+    def poll_properties(self, name):
+        """
+        Retrieve all properties of a player with a single GetAll call
+        and store them in the cache
+        """
+        device_prop = self.dbus_get_device_prop_interface(name)
+        try:
+            properties = device_prop.GetAll(MPRIS_PLAYER_INTERFACE)
+        except dbus.exceptions.DBusException:
+            # The proxy might belong to a player instance that is gone
+            self.invalidate_interfaces(name)
+            raise
+
+        with self.cache_lock:
+            entry = self.player_cache.get(name)
+            if entry is None:
+                entry = MPRISPlayerCache()
+                self.player_cache[name] = entry
+            entry.properties.update(properties)
+            entry.polled = time.time()
+            return dict(entry.properties), entry.polled
+
+    def get_properties(self, name):
+        """
+        Return the properties of a player and the time when these have
+        been retrieved. If the cached data are recent enough, no D-Bus
+        call is necessary.
+        """
+        with self.cache_lock:
+            entry = self.player_cache.get(name)
+            if entry is not None:
+                if entry.signals and self.listening:
+                    max_age = self.signal_refresh_interval
+                else:
+                    max_age = self.poll_interval
+
+                if time.time() - entry.polled < max_age:
+                    return dict(entry.properties), entry.polled
+
+        return self.poll_properties(name)
+
+    def snapshot(self, name):
+        """
+        Return playback state, metadata, position and supported commands
+        of a player. All of these are retrieved with one D-Bus round trip
+        (or none at all if the data are cached).
+        """
+        properties, updated = self.get_properties(name)
+
+        md = self.metadata_from_properties(name,
+                                           properties.get("Metadata", {}))
+        position = None
+        if "Position" in properties:
+            # MPRIS positions are in microseconds
+            position = int(properties["Position"]) / 1000000
+            md.position = position
+            md.positionupdate = updated
+
+        return {
+            "state": properties.get("PlaybackStatus"),
+            "metadata": md,
+            "position": position,
+            "supported_commands": self.commands_from_properties(properties)
+        }
+
     def retrieve_state(self, name):
     # This must be an MPRIS player
         try:
-            device_prop = self.dbus_get_device_prop_interface(name)
-            state = device_prop.Get("org.mpris.MediaPlayer2.Player",
-                                    "PlaybackStatus")
-            return state
+            return self.snapshot(name)["state"]
         except Exception as e:
             logging.warning("got exception %s while polling MPRIS data", e)
-            
-            
-    
-    def get_supported_commands(self, name):
+
+    def commands_from_properties(self, properties):
         commands = {
             "pause": "CanPause",
             "next": "CanGoNext",
@@ -79,33 +334,30 @@ class MPRIS():
             "play": "CanPlay",
             "seek": "CanSeek"
         }
+        supported_commands = ["stop"]  # Stop must always be supported
+        for command in commands:
+            if properties.get(commands[command]):
+                supported_commands.append(command)
+
+        return supported_commands
+
+    def get_supported_commands(self, name):
         try:
-            supported_commands = ["stop"]  # Stop must always be supported
-            device_prop = self.dbus_get_device_prop_interface(name)
-            for command in commands:
-                supported = device_prop.Get("org.mpris.MediaPlayer2.Player",
-                                            commands[command])
-                if supported:
-                    supported_commands.append(command)
+            return self.snapshot(name)["supported_commands"]
         except Exception as e:
             logging.warning("got exception %s", e)
+            return ["stop"]
 
-        return supported_commands
-    
-    
-    
     def send_command(self, playername, command):
-        
+
         if not playername.startswith(MPRIS_PREFIX):
             playername=MPRIS_PREFIX + playername
-            
-            
+
+
         try:
             if command in mpris_commands:
-                proxy = self.bus.get_object(playername,
-                                            "/org/mpris/MediaPlayer2")
-                player = dbus.Interface(
-                    proxy, dbus_interface='org.mpris.MediaPlayer2.Player')
+                player = self.get_interface(playername,
+                                            MPRIS_PLAYER_INTERFACE)
 
                 run_command = getattr(player, command,
                                       lambda: "Unknown command")
@@ -115,82 +367,85 @@ class MPRIS():
         except Exception as e:
             logging.error("exception %s while sending MPRIS command %s to %s",
                           e, command, playername)
+            self.invalidate_interfaces(playername)
             return False
-    
-    
+
     def get_meta(self, name):
         """
         Return the metadata for the given player instance
         """
         try:
-            device_prop = self.dbus_get_device_prop_interface(name)
-            prop = device_prop.Get(
-                "org.mpris.MediaPlayer2.Player", "Metadata")
-            try:
-                artist = array_to_string(prop.get("xesam:artist"))
-            except:
-                artist = None
+            return self.snapshot(name)["metadata"]
 
-            try:
-                title = prop.get("xesam:title")
-            except:
-                title = None
+        except dbus.exceptions.DBusException as e:
+            if "ServiceUnknown" in e.__class__.__name__:
+                # unfortunately we can't do anything about this and
+                # logging doesn't help, therefore just ignoring this case
+                pass
+                #  logging.warning("service %s disappered, cleaning up", e)
+            else:
+                logging.warning("no mpris data received %s", e.__class__.__name__)
 
-            try:
-                albumArtist = array_to_string(prop.get("xesam:albumArtist"))
-            except:
-                albumArtist = None
+            md = Metadata()
+            md.playerName = self.playername(name)
+            return md
 
-            try:
-                albumTitle = prop.get("xesam:album")
-            except:
-                albumTitle = None
+    def metadata_from_properties(self, name, prop):
+        try:
+            artist = array_to_string(prop.get("xesam:artist"))
+        except:
+            artist = None
 
-            try:
-                artURL = prop.get("mpris:artUrl")
-            except:
-                artURL = None
+        try:
+            title = prop.get("xesam:title")
+        except:
+            title = None
 
-            try:
-                discNumber = prop.get("xesam:discNumber")
-            except:
-                discNumber = None
+        try:
+            albumArtist = array_to_string(prop.get("xesam:albumArtist"))
+        except:
+            albumArtist = None
 
-            try:
-                trackNumber = prop.get("xesam:trackNumber")
-            except:
-                trackNumber = None
+        try:
+            albumTitle = prop.get("xesam:album")
+        except:
+            albumTitle = None
 
-            md = Metadata(artist, title, albumArtist, albumTitle,
-              artURL, discNumber, trackNumber)
+        try:
+            artURL = prop.get("mpris:artUrl")
+        except:
+            artURL = None
 
-            try:
-                md.streamUrl = prop.get("xesam:url")
-            except:
-                pass
+        try:
+            discNumber = prop.get("xesam:discNumber")
+        except:
+            discNumber = None
 
-            try:
-                md.trackId = prop.get("mpris:trackid")
-            except:
-                pass
+        try:
+            trackNumber = prop.get("xesam:trackNumber")
+        except:
+            trackNumber = None
 
+        md = Metadata(artist, title, albumArtist, albumTitle,
+          artURL, discNumber, trackNumber)
 
-            if (name.startswith(MPRIS_PREFIX)):
-                md.playerName = name[len(MPRIS_PREFIX):]
-            else:
-                md.playerName = name
+        try:
+            md.streamUrl = prop.get("xesam:url")
+        except:
+            pass
 
-            return md
+        try:
+            md.trackid = prop.get("mpris:trackid")
+            md.trackId = md.trackid
+        except:
+            pass
 
-        except dbus.exceptions.DBusException as e:
-            if "ServiceUnknown" in e.__class__.__name__:
-                # unfortunately we can't do anything about this and
-                # logging doesn't help, therefore just ignoring this case
-                pass
-                #  logging.warning("service %s disappered, cleaning up", e)
-            else:
-                logging.warning("no mpris data received %s", e.__class__.__name__)
+        md.playerName = self.playername(name)
 
-            md = Metadata()
-            md.playerName = self.playername(name)
-            return md
+        return md
+
+    def playername(self, name):
+        if (name.startswith(MPRIS_PREFIX)):
+            return name[len(MPRIS_PREFIX):]
+        else:
+            return name
@@ -0,0 +1,120 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import unittest
+import socket
+import threading
+
+from ac2.players.mpdcontrol import MPDControl
+from ac2.constants import CMD_NEXT
+
+
+class FakeMPD():
+    """
+    Minimal MPD server that records commands and can drop all
+    connections like MPD does after its connection_timeout
+    """
+
+    RESPONSES = {
+        "status": "state: play\nnextsong: 1\n",
+        "playlistinfo": "file: b.flac\nArtist: A\nTitle: B\n",
+    }
+
+    def __init__(self):
+        self.commands = []
+        self.connections = []
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                (conn, _addr) = self.server.accept()
+            except OSError:
+                return
+            self.connections.append(conn)
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, conn):
+        try:
+            conn.sendall(b"OK MPD 0.23.0\n")
+            for line in conn.makefile("rb"):
+                command = line.decode().split(" ")[0].strip()
+                self.commands.append(command)
+                conn.sendall((self.RESPONSES.get(command, "") + "OK\n").encode())
+        except OSError:
+            pass
+
+    def drop_connections(self):
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # client already disconnected
+                pass
+            conn.close()
+        self.connections = []
+
+    def close(self):
+        self.drop_connections()
+        self.server.close()
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.mpd = FakeMPD()
+        self.control = MPDControl({"host": "127.0.0.1",
+                                   "port": self.mpd.port,
+                                   "idle": False})
+
+    def tearDown(self):
+        self.control.disconnect()
+        self.mpd.close()
+
+    def test_command_after_disconnect(self):
+        self.assertTrue(self.control.send_command(CMD_NEXT))
+
+        # MPD closed the idle command connection
+        self.mpd.drop_connections()
+        self.assertTrue(self.control.send_command(CMD_NEXT))
+        self.assertEqual(self.mpd.commands.count("next"), 2)
+
+    def test_upcoming_after_disconnect(self):
+        self.assertEqual(len(self.control.upcoming()), 1)
+
+        # The status connection isn't used in idle mode and times out
+        self.mpd.drop_connections()
+        upcoming = self.control.upcoming()
+        self.assertEqual(len(upcoming), 1)
+        self.assertEqual(upcoming[0].title, "B")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -98,8 +98,16 @@ class VollibspotifyControl(PlayerControl):
             return STATE_STOPPED
     
     def set_state(self, state):
+        changed = (state != self.state)
         self.state=state
         self.report_alive()
+        if changed:
+            self.notify_update()
+            
+    def is_event_driven(self):
+        # The listener receives all changes from vollibrespot
+        listener = getattr(self, "listener", None)
+        return listener is not None and listener.is_alive()
         
     def report_alive(self):
         self.lastupdated = time.time()
@@ -186,10 +194,13 @@ class VollibspotifyMetadataListener(threading.Thread):
             if "metadata" in data:
                 logging.error(data["metadata"])
                 md = Metadata()
-                map_attributes(data["metadata"], md.__dict__, VOLSPOTIFY_ATTRIBUTE_MAP)
+                attributes = {}
+                map_attributes(data["metadata"], attributes, VOLSPOTIFY_ATTRIBUTE_MAP)
+                md.set_attributes(attributes)
                 md.artUrl = self.cover_url(data["metadata"]["albumartId"])
                 md.playerName = MYNAME
                 self.control.metadata = md
+                self.control.notify_update()
             elif "position_ms" in data:
                 pos=float(data["position_ms"])/1000
                 self.control.metadata.set_position(pos)
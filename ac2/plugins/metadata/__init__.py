@@ -22,36 +22,143 @@ SOFTWARE.
 
 import threading
 import logging
-import datetime
 import time
 
 
 class MetadataDisplay:
 
+    # Displays that implement notify_delta set this to receive only the
+    # changed attributes of the current song instead of full metadata
+    delta_notifications = False
+
     def __init__(self):
         logging.debug("initializing MetadataDisplay instance")
         self.notifierthread = None
-        self.starttime = None
-        self.async_delay = 1
-        pass
+        self.notify_condition = threading.Condition()
+        # Mailbox for the notifier thread. It only keeps the latest
+        # metadata, older updates that haven't been processed yet are
+        # dropped
+        self.pending_metadata = None
+        # (song_id, changed attributes) if only a delta is pending
+        self.pending_delta = None
+        self.pending_since = None
+        self.notify_stats = {
+            "notified": 0,
+            "dropped": 0,
+            "latency_last": 0,
+            "latency_max": 0,
+            "latency_total": 0,
+        }
 
     def notify(self, metadata):
         raise RuntimeError("notify not implemented")
 
+    def notify_delta(self, song_id, changed_fields):
+        """
+        Only some attributes of the current song changed, called only if
+        delta_notifications is set
+        """
+        raise RuntimeError("notify_delta not implemented")
+
     def notify_async(self, metadata):
-        # Don't run 2 async notifier threads in parallel
-        # If there is already one running. wait a bit and try again
-        if self.notifierthread is not None and self.notifierthread.is_alive():
-            time.sleep(self.async_delay)
-        
-        if self.notifierthread is not None and self.notifierthread.is_alive():            
-            logging.info("notifier background thread %s still running after %s seconds, "
-                         "not sending notify",
-                         self.notifierthread,
-                         datetime.datetime.now() - self.notifystarttime)
-        else:
-            self.notifierthread = threading.Thread(target=self.notify,
-                                                       args=(metadata,),
-                                                       name="notifier thread "+self.__str__())
-            self.notifystarttime = datetime.datetime.now()
+        """
+        Queue a notification for the notifier thread. This never blocks,
+        if the previous notification hasn't been processed yet, it will
+        be replaced by this one.
+        """
+        with self.notify_condition:
+            if self.pending_metadata is not None or \
+                    self.pending_delta is not None:
+                self.notify_stats["dropped"] += 1
+                logging.debug("%s: dropping unprocessed notification", self)
+            self.pending_metadata = metadata
+            self.pending_delta = None
+            self.pending_since = time.time()
+            self.start_notifier()
+
+    def notify_delta_async(self, song_id, changed_fields):
+        """
+        Queue a delta notification. A pending notification for the same 
+        song is merged with this one.
+        """
+        with self.notify_condition:
+            if self.pending_metadata is not None:
+                if self.pending_metadata.songId() == song_id:
+                    self.pending_metadata.set_attributes(changed_fields)
+                else:
+                    logging.debug("%s: ignoring update for previous song",
+                                  self)
+                return
+
+            if self.pending_delta is not None:
+                (pending_id, pending_fields) = self.pending_delta
+                if pending_id == song_id:
+                    pending_fields.update(changed_fields)
+                    return
+                self.notify_stats["dropped"] += 1
+
+            self.pending_delta = (song_id, dict(changed_fields))
+            self.pending_since = time.time()
+            self.start_notifier()
+
+    def start_notifier(self):
+        if self.notifierthread is None or \
+                not self.notifierthread.is_alive():
+            self.notifierthread = threading.Thread(
+                target=self.notifier_loop,
+                name="notifier thread "+self.__str__())
+            self.notifierthread.daemon = True
             self.notifierthread.start()
+
+        self.notify_condition.notify()
+
+    def notifier_loop(self):
+        while True:
+            with self.notify_condition:
+                while self.pending_metadata is None and \
+                        self.pending_delta is None:
+                    self.notify_condition.wait()
+                metadata = self.pending_metadata
+                delta = self.pending_delta
+                queued = self.pending_since
+                self.pending_metadata = None
+                self.pending_delta = None
+
+            try:
+                if metadata is not None:
+                    self.notify(metadata)
+                else:
+                    self.notify_delta(*delta)
+            except Exception as e:
+                logging.warning("could not notify %s: %s", self, e)
+                logging.exception(e)
+
+            latency = time.time() - queued
+            with self.notify_condition:
+                stats = self.notify_stats
+                stats["notified"] += 1
+                stats["latency_last"] = latency
+                stats["latency_total"] += latency
+                if latency > stats["latency_max"]:
+                    stats["latency_max"] = latency
+
+    def notify_statistics(self):
+        """
+        Returns queue depth, number of dropped notifications and
+        notification latencies (in seconds) of this display
+        """
+        with self.notify_condition:
+            stats = dict(self.notify_stats)
+            if self.pending_metadata is not None or \
+                    self.pending_delta is not None:
+                stats["queue_depth"] = 1
+            else:
+                stats["queue_depth"] = 0
+
+        latency_total = stats.pop("latency_total")
+        if stats["notified"] > 0:
+            stats["latency_avg"] = latency_total / stats["notified"]
+        else:
+            stats["latency_avg"] = 0
+
+        return stats
@@ -26,7 +26,7 @@ from typing import Dict
 class MetadataConsole(MetadataDisplay):
 
     def __init__(self, _params: Dict[str, str]=None):
-        super().__init__(self)
+        super().__init__()
         pass
 
     def notify(self, metadata):
@@ -21,8 +21,8 @@ SOFTWARE.
 '''
 
 from ac2.plugins.metadata import MetadataDisplay
+from ac2.simple_http import get_session
 
-import requests
 import logging
 import os
 import urllib.parse
@@ -33,14 +33,28 @@ class MetadataHTTPRequest(MetadataDisplay):
     Post metadata via HTTP
     '''
 
+    delta_notifications = True
+
     def __init__(self, url=None, request_type="json"):
         super().__init__()
         self.request_type = request_type
         self.url = url
-        pass
+        self.metadata = None
+
+    def notify_delta(self, song_id, changed_fields):
+        # The receiver expects full metadata, merge the changes into the
+        # last metadata that has been posted
+        if self.metadata is None or self.metadata.songId() != song_id:
+            logging.debug("ignoring update for %s", song_id)
+            return
+
+        metadata = self.metadata.copy()
+        metadata.set_attributes(changed_fields)
+        self.notify(metadata)
 
     def notify(self, metadata):
 
+        self.metadata = metadata.copy()
         localfile = None
 
         # enrich_metadata(metadata)
@@ -58,7 +72,7 @@ class MetadataHTTPRequest(MetadataDisplay):
             metadata.artUrl = "artwork/" + \
                 os.path.split(localfile)[1]
                 
-        md_dict=metadata.__dict__
+        md_dict=metadata.to_dict()
         try:
             if md_dict.get("artist").lower() == "unknown artist":
                 md_dict["artist"] = None
@@ -76,9 +90,9 @@ class MetadataHTTPRequest(MetadataDisplay):
 
         if (self.request_type == "json"):
             try:
-                r = requests.post(self.url, 
-                                  json=md_dict,
-                                  timeout=10)
+                r = get_session().post(self.url,
+                                       json=md_dict,
+                                       timeout=10)
                 logging.info("posted metadata update to %s (%s)", 
                              self.url,
                              md_dict)
@@ -39,8 +39,12 @@ class LaMetricPush(MetadataDisplay):
     Post metadata to a LaMetric time device
     '''
 
+    delta_notifications = True
+
     def __init__(self, params: Dict[str, str]={}):
         super().__init__()
+        self.artist = None
+        self.title = None
         self.set_ips(params.get("ip", ""))
         if len(self.urls)==0: 
             discover = LaMetricDiscovery(self)
@@ -63,14 +67,28 @@ class LaMetricPush(MetadataDisplay):
         
 
     def notify(self, metadata):
-        if metadata.artist is None or metadata.title is None:
+        self.artist = metadata.artist
+        self.title = metadata.title
+        self.post_song()
+
+    def notify_delta(self, song_id, changed_fields):
+        # Only artist and title are displayed
+        if "artist" not in changed_fields and "title" not in changed_fields:
+            return
+
+        self.artist = changed_fields.get("artist", self.artist)
+        self.title = changed_fields.get("title", self.title)
+        self.post_song()
+
+    def post_song(self):
+        if self.artist is None or self.title is None:
             logging.debug("ignoring undefined metatdata")
             return 
         
         data = {
                 "frames": [
                     {
-                        "text": metadata.artist+"-"+metadata.title,
+                        "text": self.artist+"-"+self.title,
                         "icon": "a22046",
                         "duration": 10000,
                     }
@@ -65,7 +65,7 @@ class MetadataPostgres(MetadataDisplay):
         # Build dict and store it to database
         if self.currentmetadata is not None:
             enrich_metadata(self.currentmetadata)
-            songdict = self.currentmetadata.__dict__
+            songdict = self.currentmetadata.to_dict()
 
             # Some fields are not needed
             for attrib in ["wiki", "loveSupported"]:
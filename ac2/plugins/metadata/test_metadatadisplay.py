@@ -0,0 +1,78 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import unittest
+import threading
+
+from ac2.metadata import Metadata
+from ac2.plugins.metadata import MetadataDisplay
+
+
+class RecordingDisplay(MetadataDisplay):
+
+    delta_notifications = True
+
+    def __init__(self):
+        super().__init__()
+        self.received = []
+        self.blocked = threading.Event()
+        self.release = threading.Event()
+        self.notified = threading.Semaphore(0)
+
+    def notify(self, metadata):
+        self.received.append(("full", metadata.songId(), metadata.artUrl))
+        self.notified.release()
+        if not self.blocked.is_set():
+            # Block the first notification to queue the following ones
+            self.blocked.set()
+            self.release.wait(5)
+
+    def notify_delta(self, song_id, changed_fields):
+        self.received.append(("delta", song_id, changed_fields))
+        self.notified.release()
+
+
+class Test(unittest.TestCase):
+
+    def test_merge_delta(self):
+        display = RecordingDisplay()
+        display.notify_async(Metadata("a", "t1"))
+        self.assertTrue(display.blocked.wait(5))
+
+        # Deltas are merged into a pending full notification
+        display.notify_async(Metadata("a", "t2"))
+        display.notify_delta_async("a/t2", {"artUrl": "http://cover"})
+        display.notify_delta_async("a/t1", {"loved": True})
+        display.release.set()
+        for _i in range(2):
+            self.assertTrue(display.notified.acquire(timeout=5))
+
+        display.notify_delta_async("a/t2", {"loved": True})
+        self.assertTrue(display.notified.acquire(timeout=5))
+        self.assertEqual(display.received,
+                         [("full", "a/t1", None),
+                          ("full", "a/t2", "http://cover"),
+                          ("delta", "a/t2", {"loved": True})])
+
+
+if __name__ == "__main__":
+    unittest.main()
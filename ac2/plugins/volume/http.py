@@ -20,9 +20,10 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
-import requests
 import logging
 
+from ac2.simple_http import get_session
+
 
 class VolumeHTTPRequest():
     '''
@@ -39,7 +40,9 @@ class VolumeHTTPRequest():
 
         if (self.request_type == "json"):
             try:
-                r = requests.post(self.url, json={"percent":volume_percent})
+                r = get_session().post(self.url,
+                                       json={"percent":volume_percent},
+                                       timeout=10)
             except Exception as e:
                 logging.error("Exception when posting metadata: %s", e)
                 return
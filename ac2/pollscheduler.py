@@ -0,0 +1,150 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import heapq
+import threading
+import time
+from collections import deque
+
+from ac2.constants import STATE_PLAYING, STATE_PAUSED, STATE_STOPPED
+
+# Poll intervals in seconds by playback state
+POLL_INTERVALS = {
+    STATE_PLAYING: 1,
+    STATE_PAUSED: 5,
+    STATE_STOPPED: 30,
+}
+DEFAULT_INTERVAL = 30
+
+# Players that report their changes are only polled as a health check
+EVENT_DRIVEN_INTERVAL = 10
+
+# Failing players are retried with an exponential backoff, starting with
+# the interval of a playing player
+MAX_BACKOFF = 300
+
+
+class PollScheduler():
+    """
+    Decides when each player will be polled next. Playing players are
+    polled often, paused and stopped players less frequently. The next
+    poll times are kept in a priority queue.
+    """
+
+    def __init__(self, intervals=None, event_driven_interval=EVENT_DRIVEN_INTERVAL,
+                 max_backoff=MAX_BACKOFF, clock=time.monotonic):
+        if intervals is None:
+            intervals = dict(POLL_INTERVALS)
+        self.intervals = intervals
+        self.event_driven_interval = event_driven_interval
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (time, name), entries are outdated if next_poll[name] differs
+        self.queue = []
+        self.next_poll = {}
+        self.failures = {}
+        self.calls = deque()
+
+    def set_interval(self, state, seconds):
+        self.intervals[state] = seconds
+
+    def is_due(self, name, now=None):
+        if now is None:
+            now = self.clock()
+        with self.lock:
+            next_poll = self.next_poll.get(name)
+        return next_poll is None or next_poll <= now
+
+    def poll_now(self, name):
+        """
+        Poll this player in the next loop, e.g. because it reported a 
+        change
+        """
+        self.schedule(name, 0)
+
+    def schedule(self, name, next_poll):
+        with self.lock:
+            self.next_poll[name] = next_poll
+            heapq.heappush(self.queue, (next_poll, name))
+
+    def polled(self, name, state, failed=False, event_driven=False):
+        """
+        Record a poll of this player and schedule the next one
+        """
+        now = self.clock()
+        with self.lock:
+            self.calls.append(now)
+            if failed:
+                failures = self.failures.get(name, 0) + 1
+                self.failures[name] = failures
+                interval = min(self.intervals[STATE_PLAYING] * 2 ** failures,
+                               self.max_backoff)
+            else:
+                self.failures.pop(name, None)
+                if event_driven:
+                    interval = self.event_driven_interval
+                else:
+                    interval = self.intervals.get(state, DEFAULT_INTERVAL)
+
+        self.schedule(name, now + interval)
+
+    def retain(self, names):
+        """
+        Forget all players that are not in names
+        """
+        with self.lock:
+            for name in list(self.next_poll.keys()):
+                if name not in names:
+                    del self.next_poll[name]
+                    self.failures.pop(name, None)
+
+    def next_due(self):
+        """
+        Returns the time when the next player is due or None
+        """
+        with self.lock:
+            while len(self.queue) > 0:
+                (next_poll, name) = self.queue[0]
+                if self.next_poll.get(name) == next_poll:
+                    return next_poll
+                heapq.heappop(self.queue)
+        return None
+
+    def calls_per_minute(self):
+        now = self.clock()
+        with self.lock:
+            while len(self.calls) > 0 and self.calls[0] < now - 60:
+                self.calls.popleft()
+            return len(self.calls)
+
+    def statistics(self):
+        calls = self.calls_per_minute()
+        now = self.clock()
+        with self.lock:
+            players = {}
+            for name in self.next_poll:
+                players[name] = {
+                    "next_poll": max(0, round(self.next_poll[name] - now, 1)),
+                    "failures": self.failures.get(name, 0)
+                }
+        return {"calls_per_minute": calls, "players": players}
@@ -21,18 +21,423 @@ SOFTWARE.
 '''
 
 import logging
+import json
+import os
+import sqlite3
+import threading
+from collections import deque
+from time import time
+from urllib.parse import urlparse, urlencode, parse_qs
+
 from expiringdict import ExpiringDict
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from ac2.data.identities import host_uuid, release
 
-cache = ExpiringDict(max_len=100,
-                     max_age_seconds=600)
+CACHE_FILE = "/var/cache/audiocontrol2/http-cache.sqlite"
+
+# Maximal size of all cached response bodies
+CACHE_MAX_BYTES = 20 * 1024 * 1024
+
+# Responses from these hosts can be cached for a long time as the
+# data rarely changes
+DEFAULT_TTL = 600
+HOST_TTL = {
+    "ws.audioscrobbler.com": 7 * 86400,
+    "webservice.fanart.tv": 7 * 86400,
+    "coverartarchive.org": 30 * 86400,
+    "musicdb.hifiberry.com": 86400,
+}
+
+# Responses for a specific user (e.g. Last.FM loved state or play count)
+# change often and use the default TTL on all hosts
+USER_PARAMS = ["user", "username"]
+
+# Errors (other than 404) are only cached for a short time
+ERROR_TTL = 600
+
+# Data might be added later for a resource that doesn't exist yet
+NEGATIVE_TTL = 3600
+
+# Access times are only written if they are older than this, LRU eviction
+# doesn't need more precision and this saves writes on every lookup
+ACCESS_RESOLUTION = 3600
+
+# Return expired responses immediately and update them in the
+# background. Responses that expired more than MAX_STALE seconds ago are
+# always updated before returning them.
+stale_while_revalidate = True
+MAX_STALE = 30 * 86400
+
+# Connection pooling: number of hosts to keep connections for and
+# number of idle connections kept for a single host. Additional parallel
+# requests open new connections that are closed afterwards, they never
+# wait for a pooled connection.
+POOL_HOSTS = 20
+POOL_CONNECTIONS_PER_HOST = 4
+
+session = None
+session_lock = threading.Lock()
+latencies = deque(maxlen=1000)
+
+revalidating = set()
+revalidating_lock = threading.Lock()
+
+
+class CachedResponse():
+    """
+    The parts of a HTTP response that are stored in the cache.
+    It implements the subset of the requests.Response API that is used
+    by the data modules.
+    """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.content = content
+        self.fetched = time()
+        self.expires = None
+
+    def is_stale(self):
+        return self.expires is not None and self.expires < time()
+
+    def validators(self):
+        """
+        Returns the headers for a conditional request that checks if
+        this response is still valid
+        """
+        headers = {}
+        if "ETag" in self.headers:
+            headers["If-None-Match"] = self.headers["ETag"]
+        if "Last-Modified" in self.headers:
+            headers["If-Modified-Since"] = self.headers["Last-Modified"]
+        return headers
+
+    @staticmethod
+    def from_response(url, response):
+        return CachedResponse(url,
+                              response.status_code,
+                              dict(response.headers),
+                              response.content)
+
+    @property
+    def encoding(self):
+        content_type = self.headers.get("content-type", "")
+        for part in content_type.split(";"):
+            part = part.strip()
+            if part.lower().startswith("charset="):
+                return part[8:].strip("\"'")
+        return "utf-8"
+
+    @property
+    def text(self):
+        try:
+            return self.content.decode(self.encoding, errors="replace")
+        except LookupError:
+            return self.content.decode("utf-8", errors="replace")
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+    def __eq__(self, other):
+        if not isinstance(other, CachedResponse):
+            return False
+
+        return self.url == other.url and \
+            self.status_code == other.status_code and \
+            self.content == other.content
+
+    def __str__(self):
+        return "<CachedResponse [{}] {}>".format(self.status_code, self.url)
+
+
+class HTTPCache():
+    """
+    Persistent HTTP response cache in an SQLite database.
+
+    Entries expire based on a per-host TTL. If the total size of all
+    bodies exceeds max_bytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, filename=CACHE_FILE, max_bytes=CACHE_MAX_BYTES):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = None
+        self.size = 0
+
+    def connect(self):
+        if self.db is not None:
+            return self.db
+
+        db = None
+        if self.filename is not None and self.filename != ":memory:":
+            try:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                db = self.create_db(self.filename)
+            except Exception as e:
+                logging.warning("can't use HTTP cache %s (%s), "
+                                "using in-memory cache", self.filename, e)
+
+        if db is None:
+            db = self.create_db(":memory:")
+
+        self.db = db
+        self.size = db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self.db
+
+    def create_db(self, filename):
+        db = sqlite3.connect(filename,
+                             check_same_thread=False,
+                             isolation_level=None)
+        db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                   "url TEXT PRIMARY KEY, "
+                   "status INTEGER, "
+                   "headers TEXT, "
+                   "body BLOB, "
+                   "size INTEGER, "
+                   "fetched REAL, "
+                   "expires REAL, "
+                   "accessed REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS responses_accessed "
+                   "ON responses (accessed)")
+        return db
+
+    def get(self, url, allow_expired=False):
+        """
+        Returns the cached response for this URL or None if it is not
+        cached or expired
+        """
+        with self.lock:
+            db = self.connect()
+            row = db.execute("SELECT status, headers, body, fetched, "
+                             "expires, accessed "
+                             "FROM responses WHERE url=?",
+                             (url,)).fetchone()
+            if row is None:
+                return None
+
+            (status, headers, body, fetched, expires, accessed) = row
+            now = time()
+            if expires < now and not allow_expired:
+                return None
+
+            if accessed < now - ACCESS_RESOLUTION:
+                db.execute("UPDATE responses SET accessed=? WHERE url=?",
+                           (now, url))
+
+        res = CachedResponse(url, status, json.loads(headers), body)
+        res.fetched = fetched
+        res.expires = expires
+        return res
+
+    def renew(self, url, ttl=None, headers=None):
+        """
+        Mark a cached response as fresh again, e.g. after the server
+        confirmed that it didn't change
+        """
+        with self.lock:
+            db = self.connect()
+            row = db.execute("SELECT status, headers FROM responses "
+                             "WHERE url=?", (url,)).fetchone()
+            if row is None:
+                return
+
+            (status, stored_headers) = row
+            if ttl is None:
+                ttl = ttl_for(url, status)
+            stored_headers = json.loads(stored_headers)
+            if headers is not None:
+                for header in ["ETag", "Last-Modified", "Cache-Control",
+                               "Expires", "Date"]:
+                    if header in headers:
+                        stored_headers[header] = headers[header]
+
+            now = time()
+            db.execute("UPDATE responses SET fetched=?, expires=?, "
+                       "accessed=?, headers=? WHERE url=?",
+                       (now, now + ttl, now, json.dumps(stored_headers),
+                        url))
+
+    def put(self, url, response, ttl=None):
+        if ttl is None:
+            ttl = ttl_for(url, response.status_code)
+
+        body = response.content
+        if body is None:
+            body = b""
+        size = len(body)
+        now = time()
+
+        with self.lock:
+            db = self.connect()
+            row = db.execute("SELECT size FROM responses WHERE url=?",
+                             (url,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            db.execute("INSERT OR REPLACE INTO responses "
+                       "(url, status, headers, body, size, fetched, "
+                       "expires, accessed) VALUES (?,?,?,?,?,?,?,?)",
+                       (url, response.status_code,
+                        json.dumps(dict(response.headers)),
+                        sqlite3.Binary(body), size, now, now + ttl, now))
+            self.size += size
+            self.evict()
+
+    def evict(self):
+        # Needs to be called with the lock held
+        while self.size > self.max_bytes:
+            rows = self.db.execute("SELECT url, size FROM responses "
+                                   "ORDER BY accessed LIMIT 20").fetchall()
+            if len(rows) == 0:
+                self.size = 0
+                break
+            for (url, size) in rows:
+                self.db.execute("DELETE FROM responses WHERE url=?", (url,))
+                self.size -= size
+                logging.debug("removed %s from HTTP cache", url)
+                if self.size <= self.max_bytes:
+                    break
+
+    def clear(self):
+        with self.lock:
+            db = self.connect()
+            db.execute("DELETE FROM responses")
+            self.size = 0
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+
+cache = HTTPCache()
 negativeCache = ExpiringDict(max_len=100,
                              max_age_seconds=600)
 
 
+def set_cache_file(filename, max_bytes=CACHE_MAX_BYTES):
+    """
+    Use another file for the persistent HTTP cache
+    """
+    global cache
+    cache.close()
+    cache = HTTPCache(filename, max_bytes)
+
+
+def ttl_for(url, status_code=200):
+    if status_code >= 400 and status_code != 404:
+        return ERROR_TTL
+
+    parsed = urlparse(url)
+    # cache keys contain additional parameters after "#"
+    query = parse_qs(parsed.query)
+    query.update(parse_qs(parsed.fragment))
+    if any(param in query for param in USER_PARAMS):
+        ttl = DEFAULT_TTL
+    else:
+        ttl = HOST_TTL.get(parsed.hostname, DEFAULT_TTL)
+    if status_code == 404:
+        ttl = min(ttl, NEGATIVE_TTL)
+    return ttl
+
+
+def cache_key(url, params):
+    if params is None or len(params) == 0:
+        return url
+
+    return url + "#" + urlencode(sorted(params.items()))
+
+
+def get_session():
+    """
+    Returns the shared HTTP session. All outbound HTTP requests should use
+    this to reuse connections.
+    """
+    global session
+
+    with session_lock:
+        if session is None:
+            # Retry failed connects and idempotent requests if the server
+            # is temporarily unavailable. Read errors are not retried,
+            # otherwise every timeout would take twice as long.
+            retry = Retry(total=2, connect=1, read=0, status=2,
+                          backoff_factor=0.5,
+                          status_forcelist=[502, 503, 504],
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=POOL_HOSTS,
+                                  pool_maxsize=POOL_CONNECTIONS_PER_HOST,
+                                  pool_block=False,
+                                  max_retries=retry)
+            s = requests.Session()
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+            s.headers['User-agent'] = 'audiocontrol/{}/{}'.format(release(), host_uuid())
+            s.hooks["response"].append(record_latency)
+            session = s
+
+        return session
+
+
+def record_latency(response, *_args, **_kwargs):
+    latencies.append(response.elapsed.total_seconds())
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    index = int(round((len(values) - 1) * p / 100))
+    return values[index]
+
+
+def http_statistics():
+    """
+    Returns number of requests and connections, the connection reuse rate
+    and request latencies (in seconds) of the shared session
+    """
+    requests_sent = 0
+    connections = 0
+
+    if session is not None:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+
+    if requests_sent > 0:
+        reuse_rate = 1 - connections / requests_sent
+    else:
+        reuse_rate = None
+
+    values = list(latencies)
+    return {
+        "requests": requests_sent,
+        "connections": connections,
+        "connection_reuse_rate": reuse_rate,
+        "latency_p50": percentile(values, 50),
+        "latency_p95": percentile(values, 95),
+    }
+
+
 def clear_cache():
     cache.clear()
     negativeCache.clear()
@@ -45,39 +450,104 @@ def is_negative_cached(url):
     return url in negativeCache
 
 
-def retrieve_url(url, headers = {}, params= {}, verify=True, timeout=10):
+def retrieve_url(url, headers = {}, params= {}, verify=True, timeout=10,
+                 allow_stale=None):
 
-    if url in cache:
+    if allow_stale is None:
+        allow_stale = stale_while_revalidate
+
+    key = cache_key(url, params)
+    res = cache.get(key, allow_expired=True)
+    if res is not None and not res.is_stale():
         logging.debug("retrieved from cache: %s", url)
-        return cache[url]
+        return res
+    elif res is not None:
+        if allow_stale and time() - res.expires < MAX_STALE:
+            logging.debug("retrieved stale data from cache: %s", url)
+            revalidate_bg(url, key, res, headers, params, verify, timeout)
+            return res
+        else:
+            return revalidate(url, key, res, headers, params, verify, timeout)
     else:
         try:
-            if negativeCache.get(url) is None:
-                headers['User-agent'] = 'audiocontrol/{}/{}'.format(release(), host_uuid())
-                res = requests.get(url, 
-                                   headers=headers, 
-                                   verify=verify,
-                                   params=params,
-                                   timeout=timeout)
-                cache[url] = res
-                return res
+            if negativeCache.get(key) is None:
+                return fetch(url, key, headers, params, verify, timeout)
             else:
                 logging.debug("negative cache hit: %s", url)
         except Exception as e:
             logging.debug("HTTP exception while retrieving %s: %s", url, e)
-            negativeCache[url] = True
-            
-            
+            negativeCache[key] = True
+
+
+def fetch(url, key, headers, params, verify, timeout, cached=None):
+    """
+    Retrieve a URL and store the result in the cache. If a cached response
+    is given, a conditional request is used and the cached response is
+    returned if it didn't change.
+    """
+    request_headers = dict(headers)
+    if cached is not None:
+        request_headers.update(cached.validators())
+
+    res = get_session().get(url,
+                            headers=request_headers,
+                            verify=verify,
+                            params=params,
+                            timeout=timeout)
+
+    if cached is not None and res.status_code == 304:
+        logging.debug("%s not modified", url)
+        cache.renew(key, headers=res.headers)
+        return cached
+
+    if cached is not None and res.status_code >= 500:
+        # Keep the cached data and try again later
+        logging.debug("HTTP status %s while revalidating %s, using cached data",
+                      res.status_code, url)
+        cache.renew(key, ttl=ERROR_TTL)
+        return cached
+
+    res = CachedResponse.from_response(url, res)
+    cache.put(key, res)
+    return res
+
+
+def revalidate(url, key, cached, headers, params, verify, timeout):
+    try:
+        return fetch(url, key, headers, params, verify, timeout,
+                     cached=cached)
+    except Exception as e:
+        # Stale data are better than no data
+        logging.debug("HTTP exception while revalidating %s: %s", url, e)
+        cache.renew(key, ttl=ERROR_TTL)
+        return cached
+    finally:
+        with revalidating_lock:
+            revalidating.discard(key)
+
+
+def revalidate_bg(url, key, cached, headers, params, verify, timeout):
+    with revalidating_lock:
+        if key in revalidating:
+            return
+        revalidating.add(key)
+
+    threading.Thread(target=revalidate,
+                     args=(url, key, cached, dict(headers), params,
+                           verify, timeout),
+                     name="revalidate " + url,
+                     daemon=True).start()
+
+
 def post_data(url, data, headers = {}, verify=True, timeout=10):
     
     res = None
     try:
-        headers['User-agent'] = 'audiocontrol/{}/{}'.format(release(), host_uuid())
-        res = requests.post(url, 
-                            data = data, 
-                            headers=headers, 
-                            verify = verify,
-                            timeout = timeout)
+        res = get_session().post(url,
+                                 data = data,
+                                 headers=headers,
+                                 verify = verify,
+                                 timeout = timeout)
     except Exception as e:
         logging.debug("HTTP exception while posting %s: %s", url, e)
         
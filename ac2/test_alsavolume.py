@@ -0,0 +1,187 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import importlib.util
+import os
+import select
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+if importlib.util.find_spec("alsaaudio") is None:
+    # The mixer is mocked in all tests, the module is only needed for the
+    # import of ac2.alsavolume
+    sys.modules["alsaaudio"] = mock.MagicMock()
+
+from ac2 import alsavolume
+from ac2.alsavolume import ALSAVolume
+
+
+class FakeMixer():
+    """
+    Mixer with a volume that is shared by all instances. A byte written to
+    the pipe signals a mixer event.
+    """
+
+    volume = 0
+    writes = []
+    supports_events = True
+    pipe = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def getvolume(self):
+        return [FakeMixer.volume, FakeMixer.volume]
+
+    def setvolume(self, volume, _channel=None):
+        FakeMixer.writes.append((time.monotonic(), volume))
+        FakeMixer.volume = volume
+
+    def polldescriptors(self):
+        return [(FakeMixer.pipe[0], select.POLLIN)]
+
+    def handleevents(self):
+        if not FakeMixer.supports_events:
+            raise AttributeError("handleevents")
+        while len(select.select([FakeMixer.pipe[0]], [], [], 0)[0]) > 0:
+            os.read(FakeMixer.pipe[0], 1)
+
+
+class Listener():
+
+    def __init__(self):
+        self.volumes = []
+        self.changed = threading.Event()
+
+    def notify_volume(self, volume):
+        self.volumes.append(volume)
+        self.changed.set()
+
+    def wait_for(self, volume, timeout=2):
+        deadline = time.monotonic() + timeout
+        while volume not in self.volumes and time.monotonic() < deadline:
+            self.changed.wait(0.05)
+            self.changed.clear()
+        return volume in self.volumes
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        FakeMixer.volume = 20
+        FakeMixer.writes = []
+        FakeMixer.supports_events = True
+        FakeMixer.pipe = os.pipe()
+        patcher = mock.patch.object(alsavolume.alsaaudio, "Mixer", FakeMixer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.close(FakeMixer.pipe[0])
+        os.close(FakeMixer.pipe[1])
+
+    def start(self, volume):
+        listener = Listener()
+        volume.add_listener(listener)
+        volume.daemon = True
+        volume.start()
+        self.assertTrue(listener.wait_for(20))
+        return listener
+
+    def test_events(self):
+        volume = ALSAVolume("Master")
+        listener = self.start(volume)
+        self.assertTrue(volume.event_driven)
+
+        # A change is reported on the mixer event, much faster than
+        # EVENT_TIMEOUT
+        FakeMixer.volume = 70
+        os.write(FakeMixer.pipe[1], b"x")
+        self.assertTrue(listener.wait_for(70, timeout=1))
+        self.assertEqual(listener.volumes, [20, 70])
+
+    def test_polling_fallback(self):
+        FakeMixer.supports_events = False
+        volume = ALSAVolume("Master")
+        volume.pollinterval = 0.05
+        listener = self.start(volume)
+        self.assertFalse(volume.event_driven)
+
+        FakeMixer.volume = 40
+        self.assertTrue(listener.wait_for(40))
+        self.assertEqual(listener.volumes, [20, 40])
+
+    @mock.patch.object(alsavolume, "SETTLE_TIME", 0.1)
+    def test_coalesce(self):
+        volume = ALSAVolume("Master")
+        listener = self.start(volume)
+
+        for vol in range(21, 61):
+            volume.set_volume(vol)
+        self.assertEqual(volume.target_volume(), 60)
+        self.assertTrue(listener.wait_for(60))
+
+        # Changes are merged into a few writes, listeners only get the
+        # final volume
+        writes = [vol for (_t, vol) in FakeMixer.writes]
+        self.assertLessEqual(len(writes), 3)
+        self.assertEqual(writes[-1], 60)
+        self.assertEqual(listener.volumes, [20, 60])
+
+    @mock.patch.object(alsavolume, "SETTLE_TIME", 0.1)
+    def test_write_interval(self):
+        volume = ALSAVolume("Master")
+        listener = self.start(volume)
+
+        # e.g. a rotary encoder
+        for _i in range(20):
+            volume.change_volume_percent(1)
+            time.sleep(0.01)
+        self.assertTrue(listener.wait_for(40))
+
+        times = [t for (t, _vol) in FakeMixer.writes]
+        self.assertLess(len(times), 20)
+        for (t1, t2) in zip(times, times[1:]):
+            self.assertGreaterEqual(t2 - t1,
+                                    alsavolume.MIN_WRITE_INTERVAL * 0.9)
+
+    @mock.patch.object(alsavolume, "SETTLE_TIME", 0.1)
+    def test_ramp(self):
+        volume = ALSAVolume("Master", ramp_step=10)
+        listener = self.start(volume)
+
+        volume.set_volume(55)
+        self.assertTrue(listener.wait_for(55))
+        self.assertEqual([vol for (_t, vol) in FakeMixer.writes],
+                         [30, 40, 50, 55])
+
+        volume.set_volume(35)
+        self.assertTrue(listener.wait_for(35))
+        self.assertEqual([vol for (_t, vol) in FakeMixer.writes][4:],
+                         [45, 35])
+        self.assertEqual(listener.volumes, [20, 55, 35])
+
+
+if __name__ == "__main__":
+    unittest.main()
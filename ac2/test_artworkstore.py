@@ -0,0 +1,89 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import unittest
+import tempfile
+import os
+
+from ac2.artworkstore import ArtworkStore, size_bucket
+
+
+class Test(unittest.TestCase):
+
+    def test_add_file(self):
+        store = ArtworkStore(max_entries=2, directory=None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = []
+            for i in range(3):
+                filename = os.path.join(tmpdir, "cover{}.JPG".format(i))
+                with open(filename, "wb") as f:
+                    f.write(b"image" + bytes([i]))
+                files.append(filename)
+
+            key = store.add_file(files[0])
+            self.assertTrue(key.endswith(".jpg"))
+            self.assertNotIn("cover", key)
+            self.assertEqual(store.get(key), files[0])
+            self.assertEqual(store.add_file(files[0]), key)
+            self.assertEqual(store.content_type(key), "image/jpeg")
+
+            # Same content, same key
+            with open(files[1], "wb") as f:
+                f.write(b"image\x00")
+            self.assertEqual(store.add_file(files[1]), key)
+
+            # Oldest entries are removed
+            store.add_file(files[2])
+            with open(files[1], "wb") as f:
+                f.write(b"changed")
+            self.assertNotEqual(store.add_file(files[1]), key)
+            self.assertIsNone(store.get(key))
+
+            self.assertIsNone(store.add_file(os.path.join(tmpdir, "none.jpg")))
+
+    def test_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = ArtworkStore(directory=tmpdir, max_bytes=250)
+            keys = [store.add_data(bytes([i]) * 100, ".jpg") for i in range(3)]
+            self.assertIsNone(store.get(keys[0]))
+            self.assertIsNotNone(store.get(keys[1]))
+            self.assertEqual(store.cached_bytes, 200)
+
+            # keys[1] was used recently, keys[2] is removed
+            store.add_data(b"x" * 100, ".png")
+            self.assertIsNotNone(store.get(keys[1]))
+            self.assertIsNone(store.get(keys[2]))
+            self.assertEqual(len(os.listdir(tmpdir)), 2)
+
+            # Cached files are found after a restart
+            store = ArtworkStore(directory=tmpdir, max_bytes=250)
+            self.assertEqual(store.cached_bytes, 200)
+            self.assertIsNotNone(store.get(keys[1]))
+
+    def test_size_bucket(self):
+        self.assertEqual(size_bucket(100), 150)
+        self.assertEqual(size_bucket(300), 300)
+        self.assertEqual(size_bucket(301), 600)
+        self.assertIsNone(size_bucket(2000))
+
+
+if __name__ == "__main__":
+    unittest.main()
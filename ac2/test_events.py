@@ -0,0 +1,72 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+import unittest
+
+from ac2.events import EventBroker, format_event, \
+    EVENT_METADATA, EVENT_STATE, EVENT_VOLUME
+
+
+class Test(unittest.TestCase):
+
+    def test_publish(self):
+        broker = EventBroker()
+        broker.publish(EVENT_METADATA, {"artist": "a", "title": "t1"})
+        broker.publish(EVENT_VOLUME, {"percent": 50})
+
+        # New subscribers get the current values
+        subscriber = broker.subscribe()
+        self.assertEqual(subscriber.get(0),
+                         (EVENT_METADATA, {"artist": "a", "title": "t1"}))
+        self.assertEqual(subscriber.get(0), (EVENT_VOLUME, {"percent": 50}))
+        self.assertIsNone(subscriber.get(0))
+
+        # Only changes are sent
+        broker.publish(EVENT_METADATA, {"artist": "a", "title": "t2"})
+        self.assertEqual(subscriber.get(0), (EVENT_METADATA, {"title": "t2"}))
+        broker.publish(EVENT_VOLUME, {"percent": 50})
+        self.assertIsNone(subscriber.get(0))
+
+        broker.unsubscribe(subscriber)
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    def test_coalesce(self):
+        broker = EventBroker()
+        subscriber = broker.subscribe()
+        for i in range(100):
+            broker.publish(EVENT_VOLUME, {"percent": i})
+            broker.publish(EVENT_METADATA, {"title": "t{}".format(i),
+                                            "position": i % 2})
+        broker.publish(EVENT_STATE, {"state": "playing"})
+
+        self.assertEqual(subscriber.get(0), (EVENT_VOLUME, {"percent": 99}))
+        self.assertEqual(subscriber.get(0),
+                         (EVENT_METADATA, {"title": "t99", "position": 1}))
+        self.assertEqual(subscriber.get(0), (EVENT_STATE, {"state": "playing"}))
+        self.assertIsNone(subscriber.get(0))
+
+    def test_format(self):
+        self.assertEqual(format_event(EVENT_VOLUME, {"percent": 10}),
+                         'event: volume\ndata: {"percent": 10}\n\n')
+
+
+if __name__ == "__main__":
+    unittest.main()
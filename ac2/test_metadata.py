@@ -21,8 +21,10 @@ SOFTWARE.
 '''
 
 import unittest
+import threading
 
-from ac2.metadata import Metadata, enrich_metadata  
+from ac2.metadata import Metadata, enrich_metadata, \
+    EnrichmentPipeline, EnrichmentStage, EnrichmentScheduler, PRIORITY_PREFETCH
 
 class MetaDataTest(unittest.TestCase):
 
@@ -95,6 +97,26 @@ class MetaDataTest(unittest.TestCase):
         self.assertIn("tag2", md1.tags)
         self.assertIn("tag3", md1.tags)
         
+    def test_copy_diff(self):
+        md1 = Metadata("artist1", "song1", albumTitle="album1")
+        md1.add_tag("rock")
+        md2 = md1.copy()
+        self.assertEqual(md1.to_dict(), md2.to_dict())
+        self.assertEqual(md2.diff(md1), {})
+
+        # tags are not shared between copies
+        md2.add_tag("pop")
+        md2.artUrl = "http://test"
+        self.assertEqual(md1.tags, ["rock"])
+        self.assertEqual(md2.diff(md1), {"tags": ["rock", "pop"],
+                                         "artUrl": "http://test"})
+
+        md1.set_attributes({"loved": True, "unknown": 1})
+        self.assertTrue(md1.loved)
+        self.assertNotIn("unknown", md1.to_dict())
+        with self.assertRaises(AttributeError):
+            md1.lovedd = True
+
     def test_song_id(self):
         md1=Metadata("artist1","song1",albumTitle="abum1")
         md2=Metadata("artist1","song1",albumTitle="abum2")
@@ -178,9 +200,174 @@ class MetaDataTest(unittest.TestCase):
         self.assertEqual(md.title,"You Ain't The Problem")
         
         
+    def test_pipeline(self):
+        order = []
+        lock = threading.Lock()
+
+        def stage(name, attribute, value):
+            def run(md):
+                with lock:
+                    order.append(name)
+                # Like the real data sources, only fill in missing data
+                if getattr(md, attribute) is None:
+                    setattr(md, attribute, value)
+            return run
+
+        def needs_mbid(md):
+            with lock:
+                order.append("cover")
+            md.externalArtUrl = "http://cover/" + str(md.artistmbid)
+
+        stages = [
+            EnrichmentStage("first", stage("first", "mbid", "1")),
+            EnrichmentStage("second", stage("second", "mbid", "2")),
+            EnrichmentStage("artist", stage("artist", "artistmbid", "a"),
+                            dependencies=["first"]),
+            EnrichmentStage("cover", needs_mbid,
+                            dependencies=["artist"],
+                            requires=["artistmbid"]),
+        ]
+
+        self.partial_updates = []
+        md = Metadata("artist", "title")
+        EnrichmentPipeline(md, callback=self, stages=stages).run()
+
+        self.assertEqual(len(order), 4)
+        self.assertLess(order.index("first"), order.index("artist"))
+        self.assertLess(order.index("artist"), order.index("cover"))
+        self.assertIn(md.mbid, ["1", "2"])
+        self.assertEqual(md.artistmbid, "a")
+        self.assertEqual(md.externalArtUrl, "http://cover/a")
+        # The second mbid doesn't overwrite the first one
+        self.assertEqual(len(self.partial_updates), 3)
+
+    def test_pipeline_fallback(self):
+        ran = []
+
+        def slow_source(md):
+            md.albummbid = "album"
+
+        def cover(md):
+            ran.append(md.albummbid)
+
+        stages = [
+            EnrichmentStage("source", slow_source),
+            EnrichmentStage("cover", cover,
+                            requires=["albummbid"],
+                            fallback=["source"]),
+        ]
+        md = Metadata("artist", "title")
+        EnrichmentPipeline(md, stages=stages).run()
+        self.assertEqual(ran, ["album"])
+
+    def test_pipeline_merge_error(self):
+        ran = []
+
+        def first(md):
+            ran.append("first")
+
+        def second(md):
+            ran.append("second")
+
+        stages = [
+            EnrichmentStage("first", first),
+            EnrichmentStage("second", second, dependencies=["first"]),
+        ]
+        pipeline = EnrichmentPipeline(Metadata("artist", "title"),
+                                      stages=stages)
+
+        def merge(md, before):
+            raise ValueError("merge failed")
+
+        pipeline.merge = merge
+        finished = threading.Event()
+
+        def run():
+            pipeline.run()
+            finished.set()
+
+        threading.Thread(target=run, daemon=True).start()
+        self.assertTrue(finished.wait(5))
+        self.assertEqual(ran, ["first", "second"])
+
+    def test_scheduler(self):
+        release = threading.Event()
+        started = threading.Event()
+        enriched = []
+
+        def enrich(md, callback, cancelled):
+            started.set()
+            release.wait(5)
+            if not cancelled():
+                enriched.append(md.songId())
+
+        scheduler = EnrichmentScheduler(max_jobs=1, function=enrich)
+        running = scheduler.submit(Metadata("artist", "song1"))
+        started.wait(5)
+        scheduler.submit(Metadata("artist", "song1"))
+        scheduler.submit(Metadata("artist", "song2"))
+        scheduler.submit(Metadata("artist", "song3"))
+        self.assertTrue(running.cancelled)
+        release.set()
+
+        for _i in range(50):
+            if scheduler.statistics()["completed"] > 0:
+                break
+            threading.Event().wait(0.1)
+
+        stats = scheduler.statistics()
+        self.assertEqual(stats["deduped"], 1)
+        self.assertEqual(stats["cancelled"], 2)
+        self.assertEqual(stats["started"], 2)
+        self.assertEqual(stats["completed"], 1)
+        self.assertEqual(enriched, ["artist/song3"])
+
+    def test_scheduler_prefetch(self):
+        release = threading.Event()
+        started = threading.Event()
+        enriched = []
+
+        def enrich(md, callback, cancelled):
+            started.set()
+            release.wait(5)
+            if not cancelled():
+                enriched.append(md.songId())
+
+        prefetched = []
+
+        def prefetch(md, callback, cancelled):
+            if not cancelled():
+                prefetched.append(md.songId())
+
+        scheduler = EnrichmentScheduler(max_jobs=1, function=enrich,
+                                        prefetch_function=prefetch)
+        scheduler.submit(Metadata("artist", "song1"))
+        started.wait(5)
+        scheduler.submit(Metadata("artist", "next1"), None, PRIORITY_PREFETCH)
+        scheduler.submit(Metadata("artist", "next2"), None, PRIORITY_PREFETCH)
+        # next2 becomes current before its prefetch started
+        scheduler.submit(Metadata("artist", "next2"), self)
+        scheduler.submit(Metadata("artist", "next3"), None, PRIORITY_PREFETCH)
+        release.set()
+
+        for _i in range(50):
+            if scheduler.statistics()["completed"] >= 2:
+                break
+            threading.Event().wait(0.1)
+
+        # song1 is replaced by next2, the stale prefetch of next1 is
+        # cancelled, next3 is prefetched without reporting results
+        self.assertEqual(enriched, ["artist/next2"])
+        self.assertEqual(prefetched, ["artist/next3"])
+        stats = scheduler.statistics()
+        self.assertEqual(stats["prefetched"], 3)
+        self.assertEqual(stats["cancelled"], 2)
+
     def update_metadata_attributes(self, updates, song_id):
         self.updates = updates
         self.song_id = song_id
+        if hasattr(self, "partial_updates"):
+            self.partial_updates.append(updates)
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
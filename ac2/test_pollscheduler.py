@@ -0,0 +1,95 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import unittest
+
+from ac2.pollscheduler import PollScheduler
+from ac2.constants import STATE_PLAYING, STATE_PAUSED, STATE_STOPPED
+
+
+class Clock():
+
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+class Test(unittest.TestCase):
+
+    def test_intervals(self):
+        clock = Clock()
+        scheduler = PollScheduler(clock=clock)
+        self.assertTrue(scheduler.is_due("a"))
+        self.assertIsNone(scheduler.next_due())
+
+        scheduler.polled("a", STATE_PLAYING)
+        scheduler.polled("b", STATE_PAUSED)
+        scheduler.polled("c", STATE_STOPPED)
+        scheduler.polled("d", STATE_PLAYING, event_driven=True)
+        self.assertEqual(scheduler.next_due(), 1001)
+
+        clock.now = 1001
+        self.assertTrue(scheduler.is_due("a"))
+        self.assertFalse(scheduler.is_due("b"))
+        scheduler.polled("a", STATE_STOPPED)
+        self.assertEqual(scheduler.next_due(), 1005)
+
+        clock.now = 1005
+        self.assertTrue(scheduler.is_due("b"))
+        self.assertFalse(scheduler.is_due("c"))
+        self.assertFalse(scheduler.is_due("d"))
+        self.assertEqual(scheduler.calls_per_minute(), 5)
+
+        # Events make a player due immediately
+        scheduler.poll_now("c")
+        self.assertTrue(scheduler.is_due("c"))
+        self.assertEqual(scheduler.next_due(), 0)
+
+        clock.now = 1100
+        self.assertEqual(scheduler.calls_per_minute(), 0)
+
+    def test_backoff(self):
+        clock = Clock()
+        scheduler = PollScheduler(clock=clock, max_backoff=10)
+        delays = []
+        for _i in range(5):
+            scheduler.polled("a", "unknown", failed=True)
+            delays.append(scheduler.next_due() - clock.now)
+        self.assertEqual(delays, [2, 4, 8, 10, 10])
+
+        scheduler.polled("a", STATE_PLAYING)
+        self.assertEqual(scheduler.next_due(), 1001)
+        self.assertEqual(scheduler.statistics()["players"]["a"]["failures"], 0)
+
+    def test_retain(self):
+        scheduler = PollScheduler(clock=Clock())
+        scheduler.polled("a", STATE_PLAYING)
+        scheduler.polled("b", STATE_STOPPED)
+        scheduler.retain(["b"])
+        self.assertEqual(scheduler.next_due(), 1030)
+        self.assertEqual(list(scheduler.statistics()["players"].keys()), ["b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
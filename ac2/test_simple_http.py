@@ -21,9 +21,17 @@ SOFTWARE.
 '''
 
 import unittest
+import tempfile
+import os
+import threading
+import time
 from datetime import datetime
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
-from ac2.simple_http import retrieve_url, post_data, is_cached, is_negative_cached, clear_cache
+import ac2.simple_http as simple_http
+from ac2.simple_http import retrieve_url, post_data, is_cached, is_negative_cached, clear_cache, \
+    HTTPCache, CachedResponse, ttl_for, cache_key, DEFAULT_TTL, ERROR_TTL, \
+    NEGATIVE_TTL
 
 GOOGLE = "https://google.com"
 NOT_EXISTING = "http://does-not-exist.nowhere.none"
@@ -31,8 +39,45 @@ BAD_CERT = "https://wrong.host.badssl.com"
 POST = "https://webhook.site/d6c0f2b6-c361-4952-bab5-d95bba6a0fc3"
 TIMEOUT = "http://2.2.2.2"
 
+class ETagHandler(BaseHTTPRequestHandler):
+
+    requests = []
+    error = None
+
+    def do_GET(self):
+        ETagHandler.requests.append(self.headers.get("If-None-Match"))
+        if ETagHandler.error is not None:
+            self.send_response(ETagHandler.error)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = b"version1"
+        self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
 class Test(unittest.TestCase):
 
+    def setUp(self):
+        self.cache = simple_http.cache
+
+    def tearDown(self):
+        # Tests might use another cache file
+        if simple_http.cache is not self.cache:
+            simple_http.cache.close()
+            simple_http.cache = self.cache
 
     def test_retrieve(self):
         res1 = retrieve_url(GOOGLE)
@@ -77,6 +122,115 @@ class Test(unittest.TestCase):
         t2 = datetime.now()
         self.assertLess((t2-t1).total_seconds(),3)
 
+    def test_persistent_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "cache.sqlite")
+            res = CachedResponse("http://test/1", 200,
+                                 {"Content-Type": "application/json; charset=utf-8"},
+                                 b'{"test": "\xc3\xa4"}')
+            cache = HTTPCache(filename)
+            cache.put("http://test/1", res)
+            self.assertIn("http://test/1", cache)
+            cache.close()
+
+            # Data have to survive a restart
+            cache = HTTPCache(filename)
+            cached = cache.get("http://test/1")
+            self.assertEqual(cached, res)
+            self.assertEqual(cached.json()["test"], "\u00e4")
+            self.assertEqual(cached.headers["content-type"],
+                             "application/json; charset=utf-8")
+
+            cache.put("http://test/2", res, ttl=-1)
+            self.assertIsNone(cache.get("http://test/2"))
+            self.assertIsNotNone(cache.get("http://test/2", allow_expired=True))
+            cache.close()
+
+    def test_cache_eviction(self):
+        cache = HTTPCache(":memory:", max_bytes=250)
+        for i in range(3):
+            cache.put("http://test/{}".format(i),
+                      CachedResponse("http://test/{}".format(i), 200, {}, b"x" * 100))
+        # The least recently used entry has to be removed
+        self.assertNotIn("http://test/0", cache)
+        self.assertIn("http://test/1", cache)
+        self.assertIn("http://test/2", cache)
+        self.assertLessEqual(cache.size, 250)
+
+    def test_ttl(self):
+        self.assertEqual(ttl_for("http://unknown.host/test"), DEFAULT_TTL)
+        self.assertGreater(ttl_for("http://coverartarchive.org/release/1"), DEFAULT_TTL)
+        self.assertEqual(ttl_for("http://coverartarchive.org/release/1", 404), NEGATIVE_TTL)
+        self.assertEqual(ttl_for("http://unknown.host/test", 404), DEFAULT_TTL)
+        # User specific data change often
+        self.assertGreater(ttl_for("http://ws.audioscrobbler.com/2.0/?method=track.getInfo"), DEFAULT_TTL)
+        self.assertEqual(ttl_for("http://ws.audioscrobbler.com/2.0/?method=track.getInfo&user=u"), DEFAULT_TTL)
+        self.assertEqual(ttl_for(cache_key("http://ws.audioscrobbler.com/2.0/", {"user": "u"})), DEFAULT_TTL)
+        self.assertEqual(ttl_for("http://coverartarchive.org/release/1", 503), ERROR_TTL)
+        self.assertEqual(cache_key("http://test", {}), "http://test")
+        self.assertNotEqual(cache_key("http://test", {"a": 1}),
+                            cache_key("http://test", {"a": 2}))
+
+    def test_revalidate(self):
+        server = HTTPServer(("127.0.0.1", 0), ETagHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/test".format(server.server_port)
+        ETagHandler.requests = []
+        simple_http.set_cache_file(":memory:")
+
+        try:
+            res = retrieve_url(url)
+            self.assertEqual(res.text, "version1")
+
+            # Expired: a conditional GET is used and returns the cached body
+            simple_http.cache.put(url, res, ttl=-1)
+            res = retrieve_url(url, allow_stale=False)
+            self.assertEqual(res.text, "version1")
+            self.assertEqual(ETagHandler.requests, [None, '"v1"'])
+            self.assertTrue(is_cached(url))
+
+            # Stale-while-revalidate: stale data are returned immediately
+            simple_http.cache.put(url, res, ttl=-1)
+            res = retrieve_url(url, allow_stale=True)
+            self.assertEqual(res.text, "version1")
+            for _i in range(50):
+                if is_cached(url):
+                    break
+                time.sleep(0.1)
+            self.assertTrue(is_cached(url))
+            self.assertEqual(len(ETagHandler.requests), 3)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_revalidate_error(self):
+        server = HTTPServer(("127.0.0.1", 0), ETagHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/error".format(server.server_port)
+        ETagHandler.requests = []
+        ETagHandler.error = None
+        simple_http.set_cache_file(":memory:")
+
+        try:
+            res = retrieve_url(url)
+            self.assertEqual(res.text, "version1")
+
+            # A server error doesn't replace the cached data
+            ETagHandler.error = 500
+            simple_http.cache.put(url, res, ttl=-1)
+            res = retrieve_url(url, allow_stale=False)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.text, "version1")
+
+            # The cached data are used until the error TTL is over
+            res = retrieve_url(url, allow_stale=False)
+            self.assertEqual(res.text, "version1")
+            self.assertEqual(len(ETagHandler.requests), 2)
+        finally:
+            ETagHandler.error = None
+            server.shutdown()
+            server.server_close()
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
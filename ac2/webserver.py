@@ -23,17 +23,29 @@ SOFTWARE.
 import logging
 import threading
 import json
-import copy
 import urllib.parse
-import pathlib
 import os
+import time
 
 from bottle import Bottle, static_file, request, response
-from expiringdict import ExpiringDict
 
 
-from ac2.metadata import Metadata
+from ac2.metadata import Metadata, enrichment_statistics
 from ac2.plugins.metadata import MetadataDisplay
+from ac2.wsgiserver import ThreadPoolServer, DEFAULT_WORKERS, DEFAULT_TIMEOUT, \
+    ENVIRON_SERVER
+from ac2.artworkstore import ArtworkStore
+from ac2.events import EventBroker, format_event, \
+    EVENT_METADATA, EVENT_STATE, EVENT_VOLUME
+from ac2.simple_http import http_statistics
+
+# Send a comment to idle event stream clients to detect disconnects
+EVENT_KEEPALIVE = 15
+
+ARTWORK_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Maximal time a long-poll request (?wait=) will wait for changes
+MAX_WAIT = 60
 
 
 class SystemControl():
@@ -70,15 +82,24 @@ class SystemControl():
 
 class AudioControlWebserver(MetadataDisplay):
 
+    delta_notifications = True
+
     def __init__(self,
                  port=80,
                  host='0.0.0.0',
                  authtoken=None,
-                 debug=False):
+                 debug=False,
+                 server="threaded",
+                 workers=DEFAULT_WORKERS,
+                 timeout=DEFAULT_TIMEOUT):
         super().__init__()
         self.port = port
         self.host = host
         self.debug = debug
+        # "threaded" or the name of a bottle server adapter
+        self.server = server
+        self.workers = workers
+        self.timeout = timeout
         self.authtoken = authtoken
         self.bottle = Bottle()
         self.route()
@@ -90,7 +111,13 @@ class AudioControlWebserver(MetadataDisplay):
         self.thread = None
         self.lovers = []
         self.updaters = []
-        self.artwork = ExpiringDict(max_len=100, max_age_seconds=36000000)
+        self.artwork = ArtworkStore()
+        self.events = EventBroker()
+        # ETags must not match after a restart, versions start at 0 again
+        self.instance = "{:x}".format(int(time.time()))
+        self.metadata_condition = threading.Condition()
+        self.metadata_version = 0
+        self.metadata_json = None
 
         self.notify(Metadata("Artist", "Title", "Album"))
 
@@ -117,6 +144,15 @@ class AudioControlWebserver(MetadataDisplay):
         self.bottle.route('/api/player/playing',
                           method="GET",
                           callback=self.playerplaying_handler)
+        self.bottle.route('/api/player/polling',
+                          method="GET",
+                          callback=self.playerpolling_handler)
+        self.bottle.route('/api/player/notifications',
+                          method="GET",
+                          callback=self.playernotifications_handler)
+        self.bottle.route('/api/player/dbus',
+                          method="GET",
+                          callback=self.playerdbus_handler)
         self.bottle.route('/api/player/activate/<player>',
                           method="POST",
                           callback=self.playeractivate_handler)
@@ -129,6 +165,9 @@ class AudioControlWebserver(MetadataDisplay):
         self.bottle.route('/api/track/metadata',
                           method="GET",
                           callback=self.metadata_handler)
+        self.bottle.route('/api/track/enrichment',
+                          method="GET",
+                          callback=self.enrichment_handler)
         self.bottle.route('/api/track/<command>',
                           method="POST",
                           callback=self.track_handler)
@@ -138,15 +177,31 @@ class AudioControlWebserver(MetadataDisplay):
         self.bottle.route('/api/volume',
                           method="POST",
                           callback=self.volume_post_handler)
+        self.bottle.route('/api/events',
+                          method="GET",
+                          callback=self.events_handler)
         self.bottle.route('/api/system/info',
                           method="GET",
                           callback=self.system_info_handler)
+        self.bottle.route('/api/system/http',
+                          method="GET",
+                          callback=self.system_http_handler)
         self.bottle.route('/api/system/<command>',
                           method="POST",
                           callback=self.system_handler)
 
+    def create_server(self):
+        if self.server == "threaded":
+            return ThreadPoolServer(host=self.host,
+                                    port=self.port,
+                                    workers=self.workers,
+                                    timeout=self.timeout)
+        else:
+            return self.server
+
     def startServer(self):
-        self.bottle.run(port=self.port,
+        self.bottle.run(server=self.create_server(),
+                        port=self.port,
                         host=self.host,
                         debug=self.debug)
 
@@ -205,9 +260,8 @@ class AudioControlWebserver(MetadataDisplay):
             response.status = 501
             return "no player control available"
 
-        states = self.player_control.states()
-
-        return (states)
+        return self.versioned_response("status",
+                                       self.player_control.versioned_states)
 
     def playerplaying_handler(self):
 
@@ -224,6 +278,30 @@ class AudioControlWebserver(MetadataDisplay):
 
         return ({"playing": playing})
 
+    def playerpolling_handler(self):
+
+        if self.player_control is None:
+            response.status = 501
+            return "no player control available"
+
+        return self.player_control.poll_statistics()
+
+    def playernotifications_handler(self):
+
+        if self.player_control is None:
+            response.status = 501
+            return "no player control available"
+
+        return self.player_control.notify_statistics()
+
+    def playerdbus_handler(self):
+
+        if self.player_control is None:
+            response.status = 501
+            return "no player control available"
+
+        return self.player_control.dbus_statistics()
+
     def system_handler(self, command):
         if not self.validate_authtoken(request):
             response.status = 403
@@ -236,6 +314,9 @@ class AudioControlWebserver(MetadataDisplay):
             response.status = 501
             return "Unknown command {}".format(command)
 
+    def system_http_handler(self):
+        return http_statistics()
+
     def system_info_handler(self):
         return json.dumps({
             "hifiberry OS": self.system_control.version(),
@@ -243,8 +324,101 @@ class AudioControlWebserver(MetadataDisplay):
         })
 
     def metadata_handler(self):
-        print(self.metadata)
-        return json.dumps(self.metadata.__dict__, skipkeys=True)
+        return self.versioned_response("metadata", self.versioned_metadata)
+
+    def versioned_metadata(self, version=None, timeout=0):
+        with self.metadata_condition:
+            if version is not None and timeout > 0:
+                self.metadata_condition.wait_for(
+                    lambda: self.metadata_version != version, timeout)
+            return (self.metadata_version, self.metadata_json)
+
+    def etag(self, name, version):
+        return '"{}-{}-{}"'.format(name, self.instance, version)
+
+    def requested_version(self, name):
+        """
+        The version the client already has, based on If-None-Match
+        """
+        etag = request.headers.get("If-None-Match")
+        if etag is None:
+            return None
+
+        try:
+            (etag_name, instance, version) = \
+                etag.replace("W/", "").strip('" ').split("-")
+            if etag_name == name and instance == self.instance:
+                return int(version)
+        except ValueError:
+            pass
+
+        return None
+
+    def versioned_response(self, name, lookup):
+        """
+        Send a cached JSON representation with an ETag. lookup(version,
+        timeout) returns the current (version, json). With ?wait=seconds
+        and If-None-Match, the request waits until the version changed.
+        """
+        known = self.requested_version(name)
+        try:
+            wait = min(float(request.query.get("wait", 0)), MAX_WAIT)
+        except ValueError:
+            wait = 0
+
+        # Other servers might have only a single thread, long-polling is
+        # only supported by the thread pool server
+        server = request.environ.get(ENVIRON_SERVER)
+        if known is not None and wait > 0 and \
+                server is not None and server.stream_started():
+            try:
+                (version, body) = lookup(known, wait)
+            finally:
+                server.stream_finished()
+        else:
+            (version, body) = lookup()
+
+        response.set_header("ETag", self.etag(name, version))
+        response.set_header("Cache-Control", "no-cache")
+        if version == known:
+            response.status = 304
+            return ""
+
+        response.content_type = "application/json"
+        return body
+
+    def events_handler(self):
+        server = request.environ.get(ENVIRON_SERVER)
+        if server is None:
+            # A stream would block servers that don't use the thread pool
+            response.status = 501
+            return "event streams require the threaded server"
+
+        if not server.stream_started():
+            response.status = 503
+            return "too many event stream clients"
+
+        response.content_type = "text/event-stream"
+        response.set_header("Cache-Control", "no-cache")
+        subscriber = self.events.subscribe()
+
+        def stream():
+            try:
+                yield "retry: 5000\n\n"
+                while True:
+                    event = subscriber.get(timeout=EVENT_KEEPALIVE)
+                    if event is None:
+                        yield ": keepalive\n\n"
+                    else:
+                        yield format_event(*event)
+            finally:
+                self.events.unsubscribe(subscriber)
+                server.stream_finished()
+
+        return stream()
+
+    def enrichment_handler(self):
+        return enrichment_statistics()
 
     def track_handler(self, command):
         if (command in ["love", "unlove"]):
@@ -287,7 +461,7 @@ class AudioControlWebserver(MetadataDisplay):
             response.status = 401
             return "percent value missing"
 
-        return ({"percent":self.volume_control.current_volume()})
+        return ({"percent":self.volume_control.target_volume()})
 
     def status_handler(self):
         response.content_type = 'text/plain; charset=UTF8'
@@ -300,15 +474,32 @@ class AudioControlWebserver(MetadataDisplay):
         return static_file(filename, root='static')
 
     def artwork_handler(self, filename):
-        logging.info("artwork filename=%s",filename)
+        try:
+            width = int(request.query.get("w", 0))
+        except ValueError:
+            width = 0
+
         realfile = self.artwork.get(filename)
         if realfile is None:
-            logging.warning("%s does not exist in cache",filename)
-            
-        if not(pathlib.Path(realfile).exists()):
-            logging.warning("%s does not exist",realfile)
-            
-        return static_file(realfile, root='/')
+            logging.debug("artwork %s does not exist in store", filename)
+            response.status = 404
+            return "unknown artwork"
+
+        # The content of an artwork URL never changes
+        etag = '"{}"'.format(filename)
+        if width > 0:
+            resized = self.artwork.get_resized(filename, width)
+            if resized != realfile:
+                realfile = resized
+                etag = '"{}"'.format(os.path.basename(resized))
+
+        # static_file handles conditional and range requests, the file is
+        # sent with sendfile by the ThreadPoolServer
+        return static_file(os.path.basename(realfile),
+                           root=os.path.dirname(realfile),
+                           mimetype=self.artwork.content_type(filename),
+                           etag=etag,
+                           headers={"Cache-Control": ARTWORK_CACHE_CONTROL})
 
     # ##
     # ## end URL handlers
@@ -352,11 +543,9 @@ class AudioControlWebserver(MetadataDisplay):
                 localfile = url.path
                 
         if localfile is not None:
-            if pathlib.Path(localfile).exists():
-                # use only file part of path name, but keep it 
-                key = str(localfile).replace("/","-").replace(" ","-")
+            key = self.artwork.add_file(localfile)
+            if key is not None:
                 metadata.artUrl = "artwork/" + key
-                self.artwork[key]=localfile
             else:
                 logging.warning("artwork file %s does not exist, removing artUrl (%s)",
                              localfile,
@@ -369,12 +558,58 @@ class AudioControlWebserver(MetadataDisplay):
     # ##
     def notify(self, metadata):
         # Create a copy, because we might need to modify the artUrl
-        metadata = copy.copy(metadata)
+        metadata = metadata.copy()
+        self.cache_external_artwork(metadata)
+        self.update_metadata(metadata)
+
+    def notify_delta(self, song_id, changed_fields):
+        metadata = self.metadata
+        if metadata is None or metadata.songId() != song_id:
+            logging.debug("ignoring update for %s", song_id)
+            return
+
+        metadata = metadata.copy()
+        metadata.set_attributes(changed_fields)
+        if "externalArtUrl" in changed_fields:
+            self.cache_external_artwork(metadata)
+        self.update_metadata(metadata)
+
+    def update_metadata(self, metadata):
         self.metadata = metadata
+        md_dict = metadata.to_dict()
+        body = json.dumps(md_dict, skipkeys=True)
+        with self.metadata_condition:
+            if body != self.metadata_json:
+                self.metadata_json = body
+                self.metadata_version += 1
+                self.metadata_condition.notify_all()
+        self.events.publish(EVENT_METADATA, md_dict)
                
 
+    def cache_external_artwork(self, metadata):
+        """
+        Serve remote artwork from the local artwork store. It will be
+        downloaded in the background, until then the remote URL is used.
+        """
+        url = metadata.externalArtUrl
+        if url is None or not url.startswith("http"):
+            return
+
+        key = self.artwork.add_url(url, self.artwork_downloaded)
+        if key is not None:
+            metadata.externalArtUrl = "artwork/" + key
+
+    def artwork_downloaded(self, url, _key):
+        metadata = self.metadata
+        if metadata is not None and metadata.externalArtUrl == url:
+            self.notify(metadata)
+
     def notify_volume(self, vol):
         self.volume = vol
+        self.events.publish(EVENT_VOLUME, {"percent": vol})
+
+    def update_playback_state(self, state):
+        self.events.publish(EVENT_STATE, {"state": state})
 
     def send_metadata_update(self, updates, song_id = None):
         if song_id is None and self.metadata is not None:
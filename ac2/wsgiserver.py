@@ -0,0 +1,229 @@
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+'''
+Concurrent WSGI server for bottle. Requests are handled by a bounded
+thread pool, a slow or stuck client doesn't block other requests.
+'''
+
+import logging
+import socket
+import threading
+from queue import Queue
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler, \
+    ServerHandler
+
+from bottle import ServerAdapter
+
+DEFAULT_WORKERS = 8
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_STREAMS = 32
+
+# WSGI environment key for the server that handles the request
+ENVIRON_SERVER = "ac2.server"
+
+
+class SendfileServerHandler(ServerHandler):
+    """
+    Sends file responses (wsgi.file_wrapper) with sendfile, the data are
+    not copied to user space
+    """
+
+    def sendfile(self):
+        filelike = getattr(self.result, "filelike", None)
+        try:
+            filelike.fileno()
+        except (AttributeError, OSError):
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        if self.environ.get("REQUEST_METHOD") == "HEAD":
+            return True
+
+        connection = self.request_handler.connection
+        self.bytes_sent += connection.sendfile(filelike)
+        return True
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    WSGI request handler with a socket timeout. Requests are logged using 
+    logging instead of stderr.
+    """
+
+    # Socket timeout in seconds, set by the server
+    timeout = DEFAULT_TIMEOUT
+
+    def address_string(self):
+        # No reverse DNS lookups
+        return self.client_address[0]
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+    def get_environ(self):
+        env = super().get_environ()
+        env[ENVIRON_SERVER] = self.server
+        return env
+
+    def handle(self):
+        """
+        Handle a single HTTP request, same as WSGIRequestHandler.handle, 
+        but using the SendfileServerHandler
+        """
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = SendfileServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+            multithread=True,
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """
+    A WSGI server that handles requests in a pool of worker threads.
+    
+    Long running responses (e.g. event streams) would block a worker for
+    a long time. These call stream_started/stream_finished and are
+    handled outside of the pool, a replacement worker is started for
+    them.
+    """
+
+    request_queue_size = 64
+
+    def __init__(self, server_address, handler_class, workers=DEFAULT_WORKERS,
+                 max_streams=DEFAULT_MAX_STREAMS):
+        super().__init__(server_address, handler_class)
+        self.workers = workers
+        self.max_streams = max_streams
+        self.streams = 0
+        # Number of workers that should exit after their current request
+        self.surplus = 0
+        self.lock = threading.Lock()
+        self.requests = Queue()
+        for _i in range(workers):
+            self.start_worker()
+
+    def start_worker(self):
+        worker = threading.Thread(target=self.worker, name="webserver")
+        worker.daemon = True
+        worker.start()
+
+    def worker(self):
+        while True:
+            (request, client_address) = self.requests.get()
+            if request is None:
+                return
+
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+            with self.lock:
+                if self.surplus > 0:
+                    self.surplus -= 1
+                    return
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def stream_started(self):
+        """
+        Called from a worker thread that will be busy for a long time.
+        Returns False if there are already too many streams.
+        """
+        with self.lock:
+            if self.streams >= self.max_streams:
+                return False
+            self.streams += 1
+        self.start_worker()
+        return True
+
+    def stream_finished(self):
+        with self.lock:
+            self.streams -= 1
+            self.surplus += 1
+
+    def handle_error(self, request, client_address):
+        logging.debug("error while handling request from %s", 
+                      client_address, exc_info=True)
+
+    def server_close(self):
+        super().server_close()
+        for _i in range(self.workers + self.streams):
+            self.requests.put((None, None))
+
+
+class ThreadPoolServer(ServerAdapter):
+    """
+    bottle server adapter for the ThreadPoolWSGIServer. 
+    
+    Options:
+    - workers: number of worker threads
+    - max_streams: maximal number of concurrent long running responses
+    - timeout: socket timeout for reading requests and sending responses
+    - handler_class: request handler (a subclass of RequestHandler)
+    """
+
+    def run(self, app):
+        workers = int(self.options.get("workers", DEFAULT_WORKERS))
+        max_streams = int(self.options.get("max_streams", DEFAULT_MAX_STREAMS))
+        timeout = float(self.options.get("timeout", DEFAULT_TIMEOUT))
+        base_handler = self.options.get("handler_class", RequestHandler)
+
+        class Handler(base_handler):
+            pass
+
+        Handler.timeout = timeout
+
+        class Server(ThreadPoolWSGIServer):
+            if ':' in self.host:
+                address_family = socket.AF_INET6
+
+            def __init__(self, server_address, handler_class):
+                super().__init__(server_address, handler_class, 
+                                 workers, max_streams)
+
+        self.srv = make_server(self.host, self.port, app, Server, Handler)
+        self.port = self.srv.server_port
+        logging.info("web server using %s worker threads, %ss timeout",
+                     workers, timeout)
+        try:
+            self.srv.serve_forever()
+        finally:
+            self.srv.server_close()
@@ -119,6 +119,11 @@ def parse_config(debugmode=False):
                   auto_pause)
     mpris.auto_pause = auto_pause
 
+    # Use D-Bus signals for MPRIS players, polling is only used as a
+    # fallback for players that don't send signals
+    if config.getboolean("mpris", "signals", fallback=True):
+        mpris.listen_mpris_signals()
+
     # Web server
     if config.getboolean("webserver", "enable", fallback=False):
         logging.debug("starting webserver")
@@ -126,10 +131,18 @@ def parse_config(debugmode=False):
                              "port",
                              fallback=80)
         token = config.get("webserver", "authtoken", fallback=None)
-        server = AudioControlWebserver(port=port, authtoken=token, debug=debugmode)
+        backend = config.get("webserver", "server", fallback="threaded")
+        workers = config.getint("webserver", "workers", fallback=8)
+        timeout = config.getfloat("webserver", "timeout", fallback=30)
+        server = AudioControlWebserver(port=port, authtoken=token, 
+                                       debug=debugmode,
+                                       server=backend,
+                                       workers=workers,
+                                       timeout=timeout)
         mpris.register_metadata_display(server)
         server.set_player_control(mpris)
         server.add_updater(mpris)
+        mpris.register_state_display(server)
         server.start()
         watchdog.add_monitored_thread(server, "webserver")
         report_activate("audiocontrol_webserver")
@@ -204,7 +217,8 @@ def parse_config(debugmode=False):
                                 "mixer_control",
                                 fallback=None)
         if mixer_name is not None:
-            volume_control = ALSAVolume(mixer_name)
+            ramp_step = config.getint("volume", "ramp_step", fallback=0)
+            volume_control = ALSAVolume(mixer_name, ramp_step=ramp_step)
             logging.info("monitoring mixer %s", mixer_name)
 
             if server is not None:
@@ -299,14 +313,21 @@ def parse_config(debugmode=False):
             
     # Native MPD backend and metadata processor
     if "mpd" in config.sections():
-        mpdc = MPDControl()
+        mpdc = MPDControl({
+            "idle": config.getboolean("mpd", "idle", fallback=True)
+            })
         mpdc.start()
         mpris.register_nonmpris_player("mpd",mpdc)
         logging.info("registered non-MPRIS mpd backend")
 
         mpddir=config.get("mpd", "musicdir",fallback=None)
         if mpddir is not None:
-            mpdproc = MpdMetadataProcessor(mpddir)
+            embedded = config.getboolean("mpd", "embedded_artwork", 
+                                         fallback=False)
+            mpdproc = MpdMetadataProcessor(mpddir, 
+                                           embedded=embedded,
+                                           host=mpdc.host,
+                                           port=mpdc.port)
             mpris.register_metadata_processor(mpdproc)
             logging.info("added MPD cover art handler on %s",mpddir)
             